@@ -1,8 +1,22 @@
 import os
+import sys
+import json
+import time
+import base64
+import queue
+import asyncio
+import signal
 import logging
-from flask import Flask, request, jsonify, render_template
+import sqlite3
+import hashlib
+import functools
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+from flask import Flask, request, jsonify, render_template, g
 from flask_cors import CORS
 import clickhouse_connect
+from clickhouse_connect.driver.exceptions import OperationalError
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 CORS(app)
@@ -19,12 +33,454 @@ werkzeug_logger = logging.getLogger("werkzeug")
 werkzeug_logger.addFilter(HealthFilter())
 
 clickhouse_host = os.environ.get("CLICKHOUSE_HOST", "localhost")
+WEB_DEBUG = os.environ.get("WEB_DEBUG", "0") == "1"
+WEB_PORT = int(os.environ.get("WEB_PORT", 5000))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))
+WEB_CONNECTION_LIMIT = int(os.environ.get("WEB_CONNECTION_LIMIT", 200))
+# Seconds an idle keep-alive connection is held open
+WEB_CHANNEL_TIMEOUT = int(os.environ.get("WEB_CHANNEL_TIMEOUT", 60))
+# Most concurrent queries a handler runs through gather_queries
+MAX_QUERY_FANOUT = 4
+# Every worker thread should be able to hold its request's ClickHouse client
+# and one per fanned out query, so that handlers waiting for fan-out slots
+# cannot starve each other
+CLICKHOUSE_POOL_SIZE = int(
+    os.environ.get("CLICKHOUSE_POOL_SIZE", WEB_THREADS * (1 + MAX_QUERY_FANOUT))
+)
+CLICKHOUSE_POOL_TIMEOUT = float(os.environ.get("CLICKHOUSE_POOL_TIMEOUT", 10))
+MAX_BATCH_SKUS = int(os.environ.get("MAX_BATCH_SKUS", 200))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+# Optional SQLite file shared by every worker process on the host
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "")
+# How often the data version bumped by scrape.entrypoint.sh is re-read
+DATA_VERSION_CHECK_INTERVAL = float(os.environ.get("DATA_VERSION_CHECK_INTERVAL", 30))
+# Idle clients older than this are pinged before being handed out again
+CLICKHOUSE_POOL_HEALTHCHECK_INTERVAL = float(
+    os.environ.get("CLICKHOUSE_POOL_HEALTHCHECK_INTERVAL", 30)
+)
+
+
+class ClickHousePool:
+    """Thread-safe pool of ClickHouse clients shared by all requests.
+
+    Clients are created lazily up to ``size``. A client that has been idle
+    for longer than ``health_check_interval`` is pinged before reuse, and
+    clients that fail a ping or raise a connection error are discarded so
+    the next borrower gets a fresh connection.
+    """
+
+    def __init__(self, host, size, timeout, health_check_interval):
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            "borrowed": 0,
+            "created": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "timeouts": 0,
+        }
+
+    def _connect(self):
+        client = clickhouse_connect.get_client(host=self.host)
+        with self._lock:
+            self._stats["created"] += 1
+
+        return client
+
+    def _healthy(self, client, idle_since):
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        with self._lock:
+            self._stats["health_checks"] += 1
+        try:
+            if client.ping():
+                return True
+        except Exception:
+            pass
+
+        with self._lock:
+            self._stats["health_check_failures"] += 1
+
+        return False
+
+    def acquire(self):
+        """Borrow a client, creating or reconnecting one when necessary."""
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            try:
+                client, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+
+                if can_create:
+                    try:
+                        client = self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                    break
+
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise queue.Empty
+                    client, idle_since = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats["timeouts"] += 1
+                    raise OperationalError(
+                        f"Timed out waiting for a ClickHouse connection ({self.size} in use)"
+                    )
+
+            if self._healthy(client, idle_since):
+                break
+            self.discard(client)
+
+        with self._lock:
+            self._stats["borrowed"] += 1
+
+        return client
+
+    def release(self, client):
+        """Return a healthy client to the pool."""
+        self._idle.put((client, time.monotonic()))
+
+    def discard(self, client):
+        """Close a broken client and free its slot for a reconnect."""
+        try:
+            client.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+            self._stats["discarded"] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = self._created
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["open"] - stats["idle"]
+
+        return stats
+
+
+ch_pool = ClickHousePool(
+    clickhouse_host,
+    size=CLICKHOUSE_POOL_SIZE,
+    timeout=CLICKHOUSE_POOL_TIMEOUT,
+    health_check_interval=CLICKHOUSE_POOL_HEALTHCHECK_INTERVAL,
+)
 
 
 def get_ch_client():
-    """Create and return a new ClickHouse client instance."""
+    """Borrow a ClickHouse client from the pool for the current request.
+
+    The client is returned to the pool when the app context is torn down.
+    """
+    if "ch_client" not in g:
+        g.ch_client = ch_pool.acquire()
+
+    return g.ch_client
+
+
+@app.teardown_appcontext
+def release_ch_client(exc):
+    client = g.pop("ch_client", None)
+
+    if client is None:
+        return
+
+    if isinstance(exc, OperationalError):
+        ch_pool.discard(client)
+    else:
+        ch_pool.release(client)
+
+
+class DataVersion:
+    """Latest data version recorded in default.data_version by the scrapers.
+
+    The value is cached for ``check_interval`` seconds so that cached
+    responses cost at most one tiny query per interval.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._value = None
+        self._checked_at = 0.0
+
+    def current(self):
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return self._value
+
+        try:
+            version = (
+                get_ch_client()
+                .query("SELECT toString(max(version)) FROM default.data_version")
+                .result_rows[0][0]
+            )
+        except Exception as e:
+            app.logger.warning(f"Unable to read data version: {e}")
+            version = self._value
+
+        with self._lock:
+            self._value = version
+            self._checked_at = time.monotonic()
+
+        return version
+
+
+class SQLiteCacheStore:
+    """Response store in a local SQLite file, shared between worker processes."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    body BLOB NOT NULL,
+                    mimetype TEXT NOT NULL,
+                    etag TEXT NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT created_at, body, mimetype, etag FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+        return tuple(row) if row else None
+
+    def set(self, key, entry):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, *entry),
+            )
+            conn.execute(
+                """
+                DELETE FROM responses WHERE key NOT IN (
+                    SELECT key FROM responses ORDER BY created_at DESC LIMIT ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+
+class ResponseCache:
+    """Size-bounded in-process LRU of rendered responses with a TTL.
+
+    Entries are ``(created_at, body, mimetype, etag)`` tuples. Misses fall
+    through to the optional shared store before the view is executed.
+    """
+
+    def __init__(self, max_entries, ttl, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "shared_hits": 0, "misses": 0}
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry):
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry
+
+        entry = None
+        if self.store is not None:
+            try:
+                entry = self.store.get(key)
+            except sqlite3.Error as e:
+                app.logger.warning(f"Shared response cache read failed: {e}")
+
+        with self._lock:
+            if self._fresh(entry):
+                self._stats["shared_hits"] += 1
+                self._put(key, entry)
+                return entry
+            self._stats["misses"] += 1
+
+        return None
+
+    def set(self, key, entry):
+        with self._lock:
+            self._put(key, entry)
+
+        if self.store is not None:
+            try:
+                self.store.set(key, entry)
+            except sqlite3.Error as e:
+                app.logger.warning(f"Shared response cache write failed: {e}")
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+
+        return stats
+
+
+data_version = DataVersion(DATA_VERSION_CHECK_INTERVAL)
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL,
+    store=(
+        SQLiteCacheStore(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES)
+        if RESPONSE_CACHE_PATH
+        else None
+    ),
+)
+
+
+def response_cache_key(version):
+    """Key a request on its path, normalised parameters and the data version."""
+    args = sorted(
+        (name, value.strip()) for name, value in request.args.items(multi=True)
+    )
+    body = request.get_json(silent=True) if request.method == "POST" else None
+
+    return json.dumps(
+        [version, request.path, args, body], sort_keys=True, ensure_ascii=False
+    )
+
+
+def cached_response(view):
+    """Serve successful responses of `view` from the response cache.
+
+    Responses carry an ETag derived from their body and a Cache-Control
+    header, and conditional requests are answered with 304.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = response_cache_key(data_version.current())
+        entry = response_cache.get(key)
+
+        if entry is None:
+            response = app.make_response(app.ensure_sync(view)(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            body = response.get_data()
+            etag = hashlib.sha1(body).hexdigest()
+            entry = (time.time(), body, response.mimetype, etag)
+            response_cache.set(key, entry)
+
+        _, body, mimetype, etag = entry
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = int(DATA_VERSION_CHECK_INTERVAL)
+        response.cache_control.must_revalidate = True
+
+        return response
+
+    return wrapper
+
+
+def pooled_query(sql, params=None):
+    """Run one query on its own pooled client and return its rows."""
+    client = ch_pool.acquire()
+    broken = False
+    try:
+        return client.query(sql, params).result_rows
+    except OperationalError:
+        broken = True
+        raise
+    finally:
+        if broken:
+            ch_pool.discard(client)
+        else:
+            ch_pool.release(client)
+
+
+async def gather_queries(*queries):
+    """Run independent (sql, params) queries concurrently.
+
+    Each query borrows its own client, since a ClickHouse session cannot run
+    two queries at once, so handler latency is that of the slowest query.
+    The pool is sized for at most MAX_QUERY_FANOUT queries per request.
+    """
+    if len(queries) > MAX_QUERY_FANOUT:
+        raise ValueError(f"At most {MAX_QUERY_FANOUT} concurrent queries")
+
+    return await asyncio.gather(
+        *(asyncio.to_thread(pooled_query, sql, params) for sql, params in queries)
+    )
+
+
+def encode_cursor(name, sku):
+    """Build an opaque keyset cursor from the last (name, sku) of a page."""
+    raw = json.dumps([name, sku], ensure_ascii=False).encode("utf-8")
+
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Return the (name, sku) pair stored in a cursor, or raise ValueError."""
+    try:
+        name, sku = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+    if not isinstance(name, str) or not isinstance(sku, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    return name, sku
+
+
+def normalize_search_text(text):
+    """Case and accent fold text the same way product_search.search_text is built."""
+    decomposed = unicodedata.normalize("NFD", text)
+    stripped = "".join(c for c in decomposed if unicodedata.category(c) != "Mn")
+
+    return stripped.lower().replace("ς", "σ")
+
 
-    return clickhouse_connect.get_client(host=clickhouse_host)
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 
 @app.route("/")
@@ -35,42 +491,71 @@ def index():
 
 
 @app.route("/products", methods=["GET"])
+@cached_response
 def get_products():
     client = get_ch_client()
     query = request.args.get("query", "")
     offset = int(request.args.get("offset", 0))
     limit = int(request.args.get("limit", 20))
+    # Passing a cursor (empty for the first page) selects keyset pagination,
+    # which seeks past the previous page instead of skipping `offset` rows.
+    cursor = request.args.get("cursor")
+
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
 
     # Build dynamic filtering
     terms = query.strip().split() if query.strip() else []
     params = {"limit": limit, "offset": offset}
+    conditions = []
+    search_conditions = []
+    latest_conditions = []
+
+    for i, term in enumerate(terms):
+        param_name = f"term{i}"
+        search_conditions.append(f"search_text LIKE %({param_name})s")
+        latest_conditions.append(f"argMax(search_text, version) LIKE %({param_name})s")
+        params[param_name] = f"%{escape_like(normalize_search_text(term))}%"
+
+    # Search terms are matched against the pre-normalised, n-gram indexed
+    # product_search table rather than scanning names with ILIKE. The index
+    # finds the candidate SKUs, which are then checked against their latest
+    # text only, so the old name of a renamed product no longer matches.
+    if search_conditions:
+        conditions.append(
+            f"""sku IN (
+                SELECT sku
+                FROM default.product_search
+                WHERE sku IN (
+                    SELECT sku
+                    FROM default.product_search
+                    WHERE {" AND ".join(search_conditions)}
+                )
+                GROUP BY sku
+                HAVING {" AND ".join(latest_conditions)}
+            )"""
+        )
 
-    if terms:
-        conditions = []
+    if cursor is not None:
+        params["offset"] = 0
 
-        for i, term in enumerate(terms):
-            param_name = f"term{i}"
-            conditions.append(
-                f"(m.name ILIKE %({param_name})s OR m.sku ILIKE %({param_name})s)"
-            )
-            params[param_name] = f"%{term}%"
-        where_clause = " AND ".join(conditions)
-    else:
-        where_clause = "1"  # No filtering
+        if cursor:
+            try:
+                params["cursor_name"], params["cursor_sku"] = decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            conditions.append("(name, sku) > (%(cursor_name)s, %(cursor_sku)s)")
 
+    where_clause = " AND ".join(conditions) if conditions else "1"
+
+    # product_listing holds the latest state of every product sorted by
+    # (name, sku), rebuilt from product_latest after every scrape, so a
+    # cursor page is a primary key range read.
     sql = f"""
-        SELECT
-            p.sku,
-            argMax(m.name, p.timestamp) AS name,
-            argMax(m.url, p.timestamp) AS url,
-            argMax(m.image_url, p.timestamp) AS image_url,
-            argMax(p.price, p.timestamp) AS price,
-            max(p.timestamp) AS timestamp
-        FROM default.products p
-        JOIN default.product_metadata m ON p.sku = m.sku
+        SELECT sku, name, url, image_url, price, timestamp
+        FROM default.product_listing
         WHERE {where_clause}
-        GROUP BY p.sku
-        ORDER BY name ASC
+        ORDER BY name ASC, sku ASC
         LIMIT %(limit)s OFFSET %(offset)s
     """
     results = client.query(sql, params).result_rows
@@ -86,115 +571,224 @@ def get_products():
         }
         for row in results
     ]
-    return jsonify(products)
+
+    if cursor is None:
+        return jsonify(products)
+
+    next_cursor = None
+    if results and len(results) == limit:
+        next_cursor = encode_cursor(results[-1][1], results[-1][0])
+
+    return jsonify({"products": products, "next_cursor": next_cursor})
+
+
+def load_price_histories(client, skus, points=None):
+    """Return {sku: {"dates", "prices"}} for the given SKUs in one query.
+
+    With ``points`` the shared date range of all SKUs is split into at most
+    that many equal buckets, and each bucket is reduced in ClickHouse to its
+    last date and price plus the bucket's min and max price.
+    """
+    params = {"skus": tuple(skus)}
+
+    if points:
+        params["points"] = points
+        sql = """
+            WITH
+                (SELECT toUInt32(min(timestamp)) FROM default.products WHERE sku IN %(skus)s) AS lo,
+                (SELECT toUInt32(max(timestamp)) FROM default.products WHERE sku IN %(skus)s) AS hi,
+                intDiv(hi - lo, %(points)s) + 1 AS width
+            SELECT
+                sku,
+                max(timestamp) AS last_timestamp,
+                argMax(price, timestamp) AS last_price,
+                min(price) AS min_price,
+                max(price) AS max_price
+            FROM default.products
+            WHERE sku IN %(skus)s
+            GROUP BY sku, intDiv(toUInt32(timestamp) - lo, width) AS bucket
+            ORDER BY sku, bucket
+        """
+    else:
+        sql = """
+            SELECT sku, timestamp, price
+            FROM default.products
+            WHERE sku IN %(skus)s
+            ORDER BY sku, timestamp ASC
+        """
+
+    histories = {sku: {"dates": [], "prices": []} for sku in skus}
+    if points:
+        for history in histories.values():
+            history["min"] = []
+            history["max"] = []
+
+    for row in client.query(sql, params).result_rows:
+        history = histories[row[0]]
+        history["dates"].append(row[1].strftime("%Y-%m-%d"))
+        history["prices"].append(float(row[2]) / 10)
+        if points:
+            history["min"].append(float(row[3]) / 10)
+            history["max"].append(float(row[4]) / 10)
+
+    return histories
 
 
 @app.route("/price-history", methods=["GET"])
+@cached_response
 def price_history():
     client = get_ch_client()
     sku = request.args.get("sku", "")
-    if not sku:
+    skus = [value for value in request.args.get("skus", "").split(",") if value]
+    points = request.args.get("points", type=int)
+    if not sku and not skus:
         return jsonify({"error": "Missing SKU"}), 400
+    if points is not None and points < 1:
+        return jsonify({"error": "points must be positive"}), 400
+    if len(skus) > MAX_BATCH_SKUS:
+        return jsonify({"error": f"At most {MAX_BATCH_SKUS} SKUs per request"}), 400
+
+    if not skus:
+        return jsonify(load_price_histories(client, [sku], points)[sku])
+
+    skus = list(dict.fromkeys(skus))
+    return jsonify({"series": load_price_histories(client, skus, points)})
+
 
-    sql = """
-        SELECT timestamp, price
-        FROM default.products
-        WHERE sku = %(sku)s
-        ORDER BY timestamp ASC
+def find_similar_products(client, skus):
+    """Return {sku: {"group_id", "similar_products"}} for every requested SKU.
+
+    The group lookup is folded into the member query as a subquery, so all
+    groups, members and latest prices are loaded in a single round trip.
     """
-    results = client.query(sql, {"sku": sku}).result_rows
-    history = {
-        "dates": [row[0].strftime("%Y-%m-%d") for row in results],
-        "prices": [float(row[1]) / 10 for row in results],
-    }
-    return jsonify(history)
+    results = {sku: {"similar_products": []} for sku in skus}
+
+    members_query = """
+        SELECT
+            p.group_id,
+            p.product_id,
+            p.name,
+            p.url,
+            p.image_url,
+            p.shop_domain,
+            p.similarity,
+            COALESCE(latest_price.price, 0) as price
+        FROM default.product_similarity_groups p
+        LEFT JOIN (
+            SELECT sku, argMaxMerge(price) as price
+            FROM default.product_latest
+            WHERE sku IN (
+                SELECT product_id
+                FROM default.product_similarity_groups
+                WHERE group_id IN (
+                    SELECT group_id
+                    FROM default.product_similarity_groups
+                    WHERE product_id IN %(skus)s
+                )
+            )
+            GROUP BY sku
+        ) as latest_price ON p.product_id = latest_price.sku
+        WHERE p.group_id IN (
+            SELECT group_id
+            FROM default.product_similarity_groups
+            WHERE product_id IN %(skus)s
+        )
+        ORDER BY p.group_id, p.similarity DESC
+    """
+    groups = {}
+    members = defaultdict(list)
+    for row in client.query(members_query, {"skus": tuple(skus)}).result_rows:
+        if row[1] in results:
+            groups.setdefault(row[1], row[0])
+        members[row[0]].append(
+            {
+                "sku": row[1],
+                "name": row[2],
+                "url": row[3],
+                "image_url": row[4],
+                "shop": row[5],
+                "similarity": float(row[6]),
+                "price": float(row[7]),
+            }
+        )
+
+    for sku, group_id in groups.items():
+        results[sku] = {
+            "group_id": group_id,
+            "similar_products": [p for p in members[group_id] if p["sku"] != sku],
+        }
+
+    return results
 
 
 @app.route("/similar-products", methods=["GET"])
+@cached_response
 def similar_products():
     client = get_ch_client()
     sku = request.args.get("sku", "")
     if not sku:
         return jsonify({"error": "Missing SKU"}), 400
 
-    group_query = """
-        SELECT group_id
-        FROM default.product_similarity_groups
-        WHERE product_id = %(sku)s
-        LIMIT 1
-    """
     try:
-        group_result = client.query(group_query, {"sku": sku}).result_rows
-        if not group_result:
-            return jsonify({"similar_products": []})
-        group_id = group_result[0][0]
-
-        similar_query = """
-            SELECT
-                p.product_id,
-                p.name,
-                p.url,
-                p.image_url,
-                p.shop_domain,
-                p.similarity,
-                COALESCE(latest_price.price, 0) as price
-            FROM default.product_similarity_groups p
-            LEFT JOIN (
-                SELECT sku, argMax(price, timestamp) as price
-                FROM default.products
-                GROUP BY sku
-            ) as latest_price ON p.product_id = latest_price.sku
-            WHERE p.group_id = %(group_id)s
-            AND p.product_id != %(sku)s
-            ORDER BY p.similarity DESC
-        """
-        similar_result = client.query(
-            similar_query, {"group_id": group_id, "sku": sku}
-        ).result_rows
-
-        similar_products = [
-            {
-                "sku": row[0],
-                "name": row[1],
-                "url": row[2],
-                "image_url": row[3],
-                "shop": row[4],
-                "similarity": float(row[5]),
-                "price": float(row[6]),
-            }
-            for row in similar_result
-        ]
-        return jsonify({"group_id": group_id, "similar_products": similar_products})
+        return jsonify(find_similar_products(client, [sku])[sku])
     except Exception as e:
         app.logger.error(f"Error fetching similar products: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/stats", methods=["GET"])
-def stats():
+@app.route("/similar-products/batch", methods=["POST"])
+@cached_response
+def similar_products_batch():
     client = get_ch_client()
-    total_distinct_products = client.query(
-        "SELECT COUNT(DISTINCT sku) FROM default.product_metadata"
-    ).result_rows[0][0]
+    payload = request.get_json(silent=True) or {}
+    skus = payload.get("skus")
+    if not isinstance(skus, list) or not skus:
+        return jsonify({"error": "Missing SKUs"}), 400
+    if len(skus) > MAX_BATCH_SKUS:
+        return jsonify({"error": f"At most {MAX_BATCH_SKUS} SKUs per request"}), 400
+
+    skus = list(dict.fromkeys(str(sku) for sku in skus))
+    try:
+        return jsonify({"results": find_similar_products(client, skus)})
+    except Exception as e:
+        app.logger.error(f"Error fetching similar products: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-    total_products = client.query(
-        "SELECT COUNT(sku) FROM default.product_metadata"
-    ).result_rows[0][0]
 
-    entries_query = client.query(
-        "SELECT timestamp, COUNT(*) AS entry_count FROM default.products GROUP BY timestamp ORDER BY timestamp ASC"
+@app.route("/stats", methods=["GET"])
+@cached_response
+async def stats():
+    """Serve statistics from the summary tables rebuilt after every scrape.
+
+    Counts are exact counts of distinct SKUs and (sku, url) listings, so they
+    do not depend on whether ReplacingMergeTree has collapsed re-inserts yet
+    (see DERIVED_TABLES in migrations.py). All four summary queries run
+    concurrently and read a few precomputed rows each.
+    """
+    duplicates_offset = int(request.args.get("duplicates_offset", 0))
+    duplicates_limit = int(request.args.get("duplicates_limit", 100))
+
+    totals, entries, duplicate_skus, items_per_host = await gather_queries(
+        (
+            "SELECT skus, listings FROM default.stats_totals",
+            None,
+        ),
+        (
+            "SELECT timestamp, count FROM default.stats_entries_per_day ORDER BY timestamp ASC",
+            None,
+        ),
+        (
+            "SELECT sku, count FROM default.stats_duplicate_skus ORDER BY sku LIMIT %(limit)s OFFSET %(offset)s",
+            {"limit": duplicates_limit, "offset": duplicates_offset},
+        ),
+        (
+            "SELECT hostname, count FROM default.stats_items_per_host ORDER BY count DESC",
+            None,
+        ),
     )
-    entries_per_day = {
-        row[0].strftime("%Y-%m-%d"): row[1] for row in entries_query.result_rows
-    }
-
-    duplicate_skus = client.query(
-        "SELECT sku, COUNT(*) AS count FROM default.product_metadata GROUP BY sku HAVING count > 1"
-    ).result_rows
-
-    items_per_host = client.query(
-        "SELECT replaceRegexpOne(url, '^https?://([^/]+).*', '\\1') AS hostname, count(*) AS count FROM default.product_metadata GROUP BY hostname ORDER BY count DESC"
-    ).result_rows
+    # Empty until the first refresh after the tables were created
+    total_distinct_products, total_products = totals[0] if totals else (0, 0)
+    entries_per_day = {row[0].strftime("%Y-%m-%d"): row[1] for row in entries}
 
     return jsonify(
         {
@@ -202,6 +796,8 @@ def stats():
             "total_distinct_products": total_distinct_products,
             "entries_per_day": entries_per_day,
             "duplicate_skus": duplicate_skus,
+            "duplicate_skus_offset": duplicates_offset,
+            "duplicate_skus_limit": duplicates_limit,
             "items_per_host": items_per_host,
         }
     )
@@ -209,8 +805,43 @@ def stats():
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok"})
+    return jsonify(
+        {
+            "status": "ok",
+            "clickhouse_pool": ch_pool.metrics(),
+            "response_cache": response_cache.metrics(),
+        }
+    )
+
+
+def serve():
+    """Run the app under waitress with a fixed pool of worker threads.
+
+    SIGTERM (docker stop) is turned into SystemExit, which makes waitress
+    stop accepting connections and let in-flight requests finish.
+    """
+    from waitress import create_server
+
+    logging.basicConfig(level=logging.INFO)
+    server = create_server(
+        app,
+        host="0.0.0.0",
+        port=WEB_PORT,
+        threads=WEB_THREADS,
+        connection_limit=WEB_CONNECTION_LIMIT,
+        channel_timeout=WEB_CHANNEL_TIMEOUT,
+        ident="metamoto",
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.logger.info(
+        f"Serving on port {WEB_PORT} with {WEB_THREADS} threads "
+        f"(ClickHouse pool size {CLICKHOUSE_POOL_SIZE})"
+    )
+    server.run()
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    if WEB_DEBUG:
+        app.run(debug=True, host="0.0.0.0", port=WEB_PORT)
+    else:
+        serve()
@@ -1,29 +1,82 @@
 #!/usr/bin/env python3
-# uv@ clickhouse-connect>=0.7.0 requests>=2.25.0 pillow>=8.0.0 numpy>=1.19.0 scikit-learn>=1.0.0 tensorflow>=2.8.0,<2.16.0
+# uv@ clickhouse-connect>=0.7.0 requests>=2.25.0 pillow>=8.0.0 numpy>=1.19.0 tensorflow>=2.8.0,<2.16.0 onnxruntime>=1.16.0
 
+import argparse
 import clickhouse_connect
 import requests
 import os
 import sys
 import time
+import sqlite3
+import socket
+import random
+import fcntl
+import multiprocessing
+import tempfile
+import functools
+import re
+import threading
 from PIL import Image
 from io import BytesIO
 import numpy as np
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
-import tensorflow as tf
-from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2, preprocess_input
-from tensorflow.keras.preprocessing import image as keras_image
-from sklearn.metrics.pairwise import cosine_similarity
-from collections import defaultdict
+from collections import Counter, defaultdict, deque, namedtuple
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 import traceback
 import json
 
 # Set up global variables
 IMAGE_CACHE_DIR = "image_cache"
 FEATURE_CACHE_DIR = "feature_cache"
-PROCESSED_CACHE_FILE = "processed_products.json"
 SIMILARITY_THRESHOLD = 0.85  # Cosine similarity threshold for matching images
+# Upper bound on the number of float32 similarity scores held in memory at once
+SIMILARITY_BLOCK_ELEMENTS = int(os.environ.get("SIMILARITY_BLOCK_ELEMENTS", 2**24))
+# Approximate nearest-neighbour search used for cross-shop matching
+ANN_BACKEND = os.environ.get("ANN_BACKEND", "ivf")  # exact, ivf or hnsw
+ANN_TOP_K = int(os.environ.get("ANN_TOP_K", 10))
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+# Embedding model: tf (Keras, float32) or onnx (ONNX Runtime, int8 via --export-onnx)
+EMBEDDER = os.environ.get("EMBEDDER", "tf")
+ONNX_MODEL_PATH = os.environ.get(
+    "ONNX_MODEL_PATH",
+    os.path.join(FEATURE_CACHE_DIR, "models", "mobilenet_v2.int8.onnx"),
+)
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", 0))
+# Sharded work mode (--worker): products are split into shards by SKU hash and
+# workers claim shards through a lease table
+WORK_SHARDS = int(os.environ.get("WORK_SHARDS", 64))
+WORK_LEASE_BACKEND = os.environ.get("WORK_LEASE_BACKEND", "clickhouse")
+WORK_LEASE_TTL = int(os.environ.get("WORK_LEASE_TTL", 600))
+WORK_LEASE_SETTLE = float(os.environ.get("WORK_LEASE_SETTLE", 1.0))
+WORK_LEASE_DB = os.environ.get(
+    "WORK_LEASE_DB", os.path.join(FEATURE_CACHE_DIR, "leases.sqlite")
+)
+# Products whose perceptual hashes differ in at most this many bits are grouped
+# before any embedding comparison (-1 disables the prefilter)
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", 4))
+# Feature extraction pipeline
+INFERENCE_BATCH_SIZE = int(os.environ.get("INFERENCE_BATCH_SIZE", 64))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 16))
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", os.cpu_count() or 1))
+PIPELINE_PREFETCH = int(os.environ.get("PIPELINE_PREFETCH", 4 * INFERENCE_BATCH_SIZE))
+# Image downloads
+DOWNLOAD_PER_HOST_LIMIT = int(os.environ.get("DOWNLOAD_PER_HOST_LIMIT", 8))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF = float(os.environ.get("DOWNLOAD_BACKOFF", 0.5))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 10))
+# Retries of a failed feature insert, backing off from INSERT_BACKOFF seconds
+INSERT_RETRIES = int(os.environ.get("INSERT_RETRIES", 3))
+INSERT_BACKOFF = float(os.environ.get("INSERT_BACKOFF", 1.0))
+# Byte budget of the image cache, least recently used images are evicted first
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 5 * 1024**3))
+# Cached images are revalidated with a conditional GET once they are this old
+IMAGE_REVALIDATE_AFTER = float(os.environ.get("IMAGE_REVALIDATE_AFTER", 24 * 3600))
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", 0))
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", 0))
 
 # Create necessary directories
 os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
@@ -33,93 +86,1610 @@ os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
 # Initialize the model
 def get_model():
     """Load and return the pre-trained MobileNetV2 model for feature extraction"""
+    import tensorflow as tf
+    from tensorflow.keras.applications.mobilenet_v2 import MobileNetV2
+
     print("Loading MobileNetV2 model...")
     # Use a compatible configuration for the model
     base_model = MobileNetV2(
         weights="imagenet", include_top=False, pooling="avg", input_shape=(224, 224, 3)
     )
 
-    # Use the base model as a feature extractor
-    model = tf.keras.Model(inputs=base_model.input, outputs=base_model.output)
+    # Use the base model as a feature extractor
+    model = tf.keras.Model(inputs=base_model.input, outputs=base_model.output)
+
+    # Set model to inference mode
+    model.trainable = False
+
+    print("Model loaded successfully.")
+
+    return model
+
+
+def extract_domain(url):
+    """Extract domain from URL"""
+    try:
+        parsed_url = urlparse(url)
+        domain = parsed_url.netloc
+        # Remove www. prefix if present
+
+        if domain.startswith("www."):
+            domain = domain[4:]
+
+        return domain
+    except:
+        return ""
+
+
+# Magic numbers of the image formats the shops serve
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"RIFF", "webp"),
+]
+
+CachedImage = namedtuple("CachedImage", ["path", "content_hash"])
+
+
+def sniff_image_extension(content):
+    """Guess the file extension of image bytes from their magic number"""
+    for signature, extension in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return extension
+
+    return "bin"
+
+
+class ImageCache:
+    """Content-addressed, size-bounded image cache.
+
+    Images are stored once per SHA-256 of their bytes under hash-prefix
+    shards (objects/ab/cd/<hash>.<ext>), so identical images served under
+    different URLs share one file. A SQLite index maps URLs to content
+    hashes and HTTP validators, and tracks blob sizes and last access for
+    LRU eviction once IMAGE_CACHE_MAX_BYTES is exceeded. Files are written
+    to a temporary name and renamed into place, so readers never see a
+    partially written image.
+
+    Decodes go through decode(), which tracks them by content hash:
+    concurrent requests for the same image share one decode, and eviction
+    skips images with a decode in flight.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.sqlite")
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        # Decode futures by content hash, while they are running
+        self._decoding = {}
+        self._decoding_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    checked_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    content_hash TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            self._local.conn = conn
+
+        return conn
+
+    def _blob_path(self, content_hash, extension):
+        return os.path.join(
+            self.root,
+            "objects",
+            content_hash[:2],
+            content_hash[2:4],
+            f"{content_hash}.{extension}",
+        )
+
+    def lookup(self, url):
+        """Return (CachedImage, etag, last_modified, checked_at) or None"""
+        conn = self._connect()
+        row = conn.execute(
+            """
+            SELECT b.path, u.content_hash, u.etag, u.last_modified, u.checked_at
+            FROM urls u JOIN blobs b ON b.content_hash = u.content_hash
+            WHERE u.url = ?
+            """,
+            (url,),
+        ).fetchone()
+
+        if row is None or not os.path.exists(row[0]):
+            return None
+
+        with conn:
+            conn.execute(
+                "UPDATE blobs SET last_access = ? WHERE content_hash = ?",
+                (time.time(), row[1]),
+            )
+
+        return CachedImage(row[0], row[1]), row[2], row[3], row[4]
+
+    def recent_paths(self, limit):
+        """Return the paths of up to limit most recently used images"""
+        rows = self._connect().execute(
+            "SELECT path FROM blobs ORDER BY last_access DESC LIMIT ?", (limit,)
+        )
+
+        return [row[0] for row in rows if os.path.exists(row[0])]
+
+    def revalidated(self, url, etag, last_modified):
+        """Record a 304 for url, refreshing its validators"""
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE urls
+                SET etag = coalesce(?, etag),
+                    last_modified = coalesce(?, last_modified),
+                    checked_at = ?
+                WHERE url = ?
+                """,
+                (etag, last_modified, time.time(), url),
+            )
+
+    def put(self, url, content, etag=None, last_modified=None):
+        """Store image bytes fetched from url and return the CachedImage"""
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(content_hash, sniff_image_extension(content))
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                (content_hash, path, len(content), now),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)",
+                (url, content_hash, etag, last_modified, now),
+            )
+
+        self.evict()
+
+        return CachedImage(path, content_hash)
+
+    def decode(self, image, decode_pool, decoder):
+        """Return a future of decoder(image.path) run on decode_pool.
+
+        Concurrent calls for the same content hash get the same future, and
+        the blob is not evicted until it resolved.
+        """
+        with self._decoding_lock:
+            future = self._decoding.get(image.content_hash)
+            if future is not None:
+                return future
+
+            future = decode_pool.submit(decoder, image.path)
+            self._decoding[image.content_hash] = future
+
+        def done(_):
+            with self._decoding_lock:
+                if self._decoding.get(image.content_hash) is future:
+                    del self._decoding[image.content_hash]
+
+        future.add_done_callback(done)
+
+        return future
+
+    def evict(self):
+        """Delete least recently used blobs until the cache fits its budget"""
+        if not self.max_bytes or not self._evict_lock.acquire(blocking=False):
+            return
+
+        try:
+            conn = self._connect()
+            total = conn.execute("SELECT coalesce(sum(size), 0) FROM blobs").fetchone()[
+                0
+            ]
+            if total <= self.max_bytes:
+                return
+
+            # Evict down to 90% of the budget so eviction does not run on every put
+            target = int(self.max_bytes * 0.9)
+            evicted = 0
+            for content_hash, path, size in conn.execute(
+                "SELECT content_hash, path, size FROM blobs ORDER BY last_access"
+            ).fetchall():
+                if total <= target:
+                    break
+                # Still being decoded, evicted by a later pass if at all
+                with self._decoding_lock:
+                    if content_hash in self._decoding:
+                        continue
+                with conn:
+                    conn.execute(
+                        "DELETE FROM blobs WHERE content_hash = ?", (content_hash,)
+                    )
+                    conn.execute(
+                        "DELETE FROM urls WHERE content_hash = ?", (content_hash,)
+                    )
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+
+            print(f"Evicted {evicted} images from the image cache")
+        finally:
+            self._evict_lock.release()
+
+
+class ImageDownloader:
+    """Pooled, retrying image downloader with per-host concurrency limits.
+
+    One keep-alive session is shared by all download threads. Transient
+    failures (connection errors, 429 and 5xx) are retried with exponential
+    backoff. Cached images are revalidated with If-None-Match and
+    If-Modified-Since using the validators stored in the image cache.
+    """
+
+    def __init__(self, cache, per_host_limit, pool_size, retries, backoff):
+        self.cache = cache
+        self.per_host_limit = per_host_limit
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+
+            return self._host_slots[host]
+
+    def fetch(self, image_url, product_id):
+        """Download or revalidate image_url, returning a CachedImage or None"""
+        cached = self.cache.lookup(image_url)
+        headers = {}
+
+        if cached is not None:
+            image, etag, last_modified, checked_at = cached
+
+            if time.time() - checked_at < IMAGE_REVALIDATE_AFTER:
+                return image
+
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            with self._host_slot(image_url):
+                response = self.session.get(
+                    image_url, headers=headers, timeout=DOWNLOAD_TIMEOUT
+                )
+        except Exception as e:
+            print(f"Error downloading image for product {product_id}: {e}")
+
+            # A stale copy is better than nothing
+            return cached[0] if cached else None
+
+        if response.status_code == 304 and cached:
+            self.cache.revalidated(
+                image_url,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+
+            return cached[0]
+
+        if response.status_code == 200:
+            return self.cache.put(
+                image_url,
+                response.content,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+
+        print(
+            f"Failed to download image for product {product_id}: HTTP {response.status_code}"
+        )
+
+        return cached[0] if cached else None
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+downloader = ImageDownloader(
+    image_cache,
+    per_host_limit=DOWNLOAD_PER_HOST_LIMIT,
+    pool_size=DOWNLOAD_WORKERS,
+    retries=DOWNLOAD_RETRIES,
+    backoff=DOWNLOAD_BACKOFF,
+)
+
+
+def download_image(image_url, product_id):
+    """Download image from URL into the image cache, returning a CachedImage"""
+
+    return downloader.fetch(image_url, product_id)
+
+
+def difference_hash(img):
+    """64-bit dHash: signs of horizontal gradients of a 9x8 grayscale thumbnail"""
+    pixels = np.asarray(img.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+    return int(bits.view(">u8")[0])
+
+
+def preprocess_image(image_path):
+    """Load an image and return (MobileNetV2 input, dHash of the image)
+
+    The input is the same as keras load_img (nearest resize to 224x224)
+    followed by the MobileNetV2 preprocess_input scaling to [-1, 1],
+    without importing TensorFlow.
+    """
+    try:
+        with Image.open(image_path) as img:
+            img = img.convert("RGB")
+            phash = difference_hash(img)
+            if img.size != (224, 224):
+                img = img.resize((224, 224), Image.NEAREST)
+            array = np.asarray(img, dtype=np.float32)
+
+        return array / 127.5 - 1.0, phash
+    except Exception as e:
+        print(f"Error preprocessing image {image_path}: {e}")
+        traceback.print_exc()
+
+        return None
+
+
+def submit_image_pipeline(product, download_pool, decode_pool):
+    """Download and then preprocess the image of a product on the two pools.
+
+    Returns a future resolving to (content_hash, preprocessed image, dHash),
+    or None when the download or the decoding failed.
+    """
+    result = Future()
+
+    def set_from(content_hash, future):
+        try:
+            prepared = future.result()
+            result.set_result(None if prepared is None else (content_hash, *prepared))
+        except Exception as e:
+            print(f"Error preparing image for product {product[0]}: {e}")
+            result.set_result(None)
+
+    def downloaded(future):
+        try:
+            cached = future.result()
+        except Exception as e:
+            print(f"Error downloading image for product {product[0]}: {e}")
+            cached = None
+
+        if cached is None:
+            result.set_result(None)
+        else:
+            image_cache.decode(cached, decode_pool, preprocess_image).add_done_callback(
+                functools.partial(set_from, cached.content_hash)
+            )
+
+    download_pool.submit(download_image, product[3], product[0]).add_done_callback(
+        downloaded
+    )
+
+    return result
+
+
+def iter_preprocessed_images(products):
+    """Yield (product, (content_hash, image, dHash) or None) in order, working ahead.
+
+    At most PIPELINE_PREFETCH products are in flight, which bounds the
+    memory held by decoded images.
+    """
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS) as download_pool, ThreadPoolExecutor(
+        DECODE_WORKERS
+    ) as decode_pool:
+        in_flight = deque()
+
+        for product in products:
+            in_flight.append(
+                (product, submit_image_pipeline(product, download_pool, decode_pool))
+            )
+
+            if len(in_flight) >= PIPELINE_PREFETCH:
+                product, future = in_flight.popleft()
+                yield product, future.result()
+
+        while in_flight:
+            product, future = in_flight.popleft()
+            yield product, future.result()
+
+
+def configure_tensorflow():
+    """Apply TF_INTER_OP_THREADS / TF_INTRA_OP_THREADS and set up GPUs if any"""
+    import tensorflow as tf
+
+    if TF_INTER_OP_THREADS:
+        tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+    if TF_INTRA_OP_THREADS:
+        tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+
+    print(
+        "TensorFlow threads: "
+        f"inter-op {tf.config.threading.get_inter_op_parallelism_threads() or 'auto'}, "
+        f"intra-op {tf.config.threading.get_intra_op_parallelism_threads() or 'auto'}"
+    )
+
+    # Set TensorFlow to use CPU or GPU
+    try:
+        # For TensorFlow 2.x
+        gpus = tf.config.list_physical_devices("GPU")
+
+        if gpus:
+            print(f"Found {len(gpus)} GPU(s), using GPU acceleration")
+            # Allow TensorFlow to use memory as needed
+
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+        else:
+            print("No GPUs found, using CPU for processing")
+    except:
+        # Fallback for older TensorFlow versions
+        print("Using CPU for processing (GPU detection not available)")
+        # Force CPU usage if needed
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+
+class TFEmbedder:
+    """MobileNetV2 (ImageNet, average pooled) in float32 on TensorFlow.
+
+    Embedders share preprocess_image and expose the model version recorded
+    with every feature row. Rows of different versions are never compared.
+    """
+
+    name = "tf"
+    version = "mobilenet_v2-imagenet-avg-fp32"
+
+    def __init__(self):
+        self.model = None
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        print("Configuring TensorFlow...")
+        configure_tensorflow()
+        self.model = get_model()
+
+    def embed(self, images):
+        """Return the (n, dim) features of a batch of preprocessed images"""
+        features = self.model(np.stack(images), training=False)
+
+        return np.asarray(features).reshape(len(images), -1)
+
+
+class ONNXEmbedder(TFEmbedder):
+    """MobileNetV2 exported to ONNX (int8 by default) on ONNX Runtime.
+
+    The version is derived from the model file, so re-exported models are
+    never compared with features of a previous export.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path=ONNX_MODEL_PATH):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"ONNX model {model_path} not found, create it with --export-onnx"
+            )
+
+        with open(model_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        self.model_path = model_path
+        self.version = f"{os.path.basename(model_path)}-{digest[:12]}"
+        self.session = None
+
+    @property
+    def loaded(self):
+        return self.session is not None
+
+    def load(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+
+        print(f"Loading ONNX model {self.model_path}...")
+        self.session = ort.InferenceSession(
+            self.model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, images):
+        """Return the (n, dim) features of a batch of preprocessed images"""
+        (features,) = self.session.run(
+            None, {self.input_name: np.stack(images).astype(np.float32)}
+        )
+
+        return features.reshape(len(images), -1)
+
+
+EMBEDDERS = {embedder.name: embedder for embedder in (TFEmbedder, ONNXEmbedder)}
+
+
+def export_onnx_model(output_path=ONNX_MODEL_PATH, calibration_images=200):
+    """Export the Keras MobileNetV2 to ONNX and quantize it to int8.
+
+    Weights are quantized per channel and activations are calibrated on the
+    most recently used images of the image cache (static QDQ quantization).
+    Requires tf2onnx and onnxruntime.
+    """
+    import tensorflow as tf
+    import tf2onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+
+    paths = image_cache.recent_paths(calibration_images)
+    if not paths:
+        raise RuntimeError("No cached images to calibrate with, process images first")
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    float_path = os.path.splitext(output_path)[0] + ".fp32.onnx"
+
+    embedder = TFEmbedder()
+    embedder.load()
+    tf2onnx.convert.from_keras(
+        embedder.model,
+        input_signature=(tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),),
+        opset=13,
+        output_path=float_path,
+    )
+    print(f"Exported float32 model to {float_path}")
+
+    class CachedImageReader(CalibrationDataReader):
+        def __init__(self):
+            self.images = (preprocess_image(path) for path in paths)
+
+        def get_next(self):
+            for prepared in self.images:
+                if prepared is not None:
+                    return {"input": prepared[0][np.newaxis]}
+
+            return None
+
+    print(f"Calibrating int8 quantization on {len(paths)} cached images...")
+    quantize_static(
+        float_path,
+        output_path,
+        CachedImageReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+    print(f"Exported int8 model to {output_path}")
+
+
+class FeatureStore:
+    """Append-only local store of image feature vectors.
+
+    Vectors are kept in one float32 file (features.f32), one row per
+    distinct image content hash, and memory-mapped on load. A SQLite index
+    maps content hashes to rows and products to the content hash of their
+    image, so the grouping phase reads features straight from disk without
+    a ClickHouse round trip or per-row conversions.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.data_path = os.path.join(root, "features.f32")
+        self.ann_dir = os.path.join(root, "ann")
+        os.makedirs(self.ann_dir, exist_ok=True)
+        self.lock_path = os.path.join(root, "features.lock")
+        self.conn = sqlite3.connect(os.path.join(root, "features.sqlite"), timeout=30)
+
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS vectors (
+                    content_hash TEXT PRIMARY KEY,
+                    row INTEGER NOT NULL,
+                    phash INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            columns = [
+                row[1] for row in self.conn.execute("PRAGMA table_info(vectors)")
+            ]
+            if "phash" not in columns:
+                self.conn.execute(
+                    "ALTER TABLE vectors ADD COLUMN phash INTEGER NOT NULL DEFAULT 0"
+                )
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS products (
+                    product_id TEXT PRIMARY KEY,
+                    shop_domain TEXT NOT NULL,
+                    content_hash TEXT NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS grouped (
+                    product_id TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+            )
+
+    def _meta(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+
+        return row[0] if row else 0
+
+    def product_ids(self):
+        """Return the set of product ids with stored features"""
+        return {row[0] for row in self.conn.execute("SELECT product_id FROM products")}
+
+    def vector(self, content_hash):
+        """Return the stored vector of an image content hash, or None"""
+        row = self.conn.execute(
+            "SELECT row FROM vectors WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        dim = self._meta("dim")
+        with open(self.data_path, "rb") as f:
+            f.seek(row[0] * dim * 4)
+
+            return np.frombuffer(f.read(dim * 4), dtype=np.float32)
+
+    def perceptual_hashes(self):
+        """Return the dHash of every product image that has one"""
+        return {
+            product_id: phash & 0xFFFFFFFFFFFFFFFF  # stored as signed 64-bit
+            for product_id, phash in self.conn.execute(
+                """
+                SELECT p.product_id, v.phash
+                FROM products p JOIN vectors v ON v.content_hash = p.content_hash
+                WHERE v.phash != 0
+                """
+            )
+        }
+
+    def append(self, rows):
+        """Append feature rows shaped like product_image_features inserts"""
+        if not rows:
+            return
+
+        # Worker processes on one host share the store
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._append(rows)
+
+    def _append(self, rows):
+        count = self._meta("count")
+        dim = self._meta("dim") or len(rows[0]["features"])
+
+        new_vectors = {}
+        for row in rows:
+            content_hash = row["image_hash"]
+            if content_hash in new_vectors:
+                continue
+            known = self.conn.execute(
+                "SELECT 1 FROM vectors WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if known is None:
+                new_vectors[content_hash] = row["features"]
+
+        if new_vectors:
+            matrix = np.asarray(list(new_vectors.values()), dtype=np.float32)
+            if matrix.shape[1] != dim:
+                raise ValueError(
+                    f"Feature dimension {matrix.shape[1]} does not match the store ({dim})"
+                )
+
+            # Vectors are written before the index is committed, dropping
+            # whatever an interrupted append left past the last indexed row
+            with open(self.data_path, "ab") as f:
+                f.truncate(count * dim * matrix.itemsize)
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        # SQLite integers are signed 64-bit
+        phashes = {}
+        for row in rows:
+            phash = row.get("image_phash") or 0
+            phashes[row["image_hash"]] = (
+                phash - (1 << 64) if phash >= 1 << 63 else phash
+            )
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO vectors VALUES (?, ?, ?)",
+                [(h, count + i, phashes[h]) for i, h in enumerate(new_vectors)],
+            )
+            self.conn.executemany(
+                "UPDATE vectors SET phash = ? WHERE content_hash = ? AND phash = 0",
+                [(phash, h) for h, phash in phashes.items() if phash],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?)",
+                [(r["product_id"], r["shop_domain"], r["image_hash"]) for r in rows],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("count", count + len(new_vectors)), ("dim", dim)],
+            )
+
+    def changed_since_grouping(self):
+        """Return the products whose image changed since mark_grouped.
+
+        Returns None if the products were never grouped.
+        """
+        if self.conn.execute("SELECT 1 FROM grouped LIMIT 1").fetchone() is None:
+            return None
+
+        return {
+            row[0]
+            for row in self.conn.execute(
+                """
+                SELECT p.product_id
+                FROM products p LEFT JOIN grouped g ON g.product_id = p.product_id
+                WHERE g.content_hash IS NULL OR g.content_hash != p.content_hash
+                """
+            )
+        }
+
+    def mark_grouped(self):
+        """Record the current image of every product as grouped"""
+        with self.conn:
+            self.conn.execute("DELETE FROM grouped")
+            self.conn.execute(
+                "INSERT INTO grouped SELECT product_id, content_hash FROM products"
+            )
+
+    def load(self):
+        """Return (product_features, shop_domains) backed by a read-only memmap.
+
+        product_features maps product ids to row views of the memmap, in
+        (shop_domain, product_id) order like product_image_features.
+        """
+        count, dim = self._meta("count"), self._meta("dim")
+        if not count:
+            return {}, {}
+
+        matrix = np.memmap(
+            self.data_path, dtype=np.float32, mode="r", shape=(count, dim)
+        )
+        product_features = {}
+        shop_domains = {}
+        for product_id, shop_domain, row in self.conn.execute(
+            """
+            SELECT p.product_id, p.shop_domain, v.row
+            FROM products p JOIN vectors v ON v.content_hash = p.content_hash
+            ORDER BY p.shop_domain, p.product_id
+            """
+        ):
+            product_features[product_id] = matrix[row]
+            shop_domains[product_id] = shop_domain
+
+        return product_features, shop_domains
+
+
+feature_stores = {}
+
+
+def get_feature_store(model_version):
+    """Return the feature store holding the features of one model version"""
+    if model_version not in feature_stores:
+        safe_version = re.sub(r"[^A-Za-z0-9._-]", "_", model_version)
+        feature_stores[model_version] = FeatureStore(
+            os.path.join(FEATURE_CACHE_DIR, safe_version)
+        )
+
+    return feature_stores[model_version]
+
+
+def normalize_rows(matrix):
+    """L2-normalize the rows of a float32 matrix in place (zero rows stay zero)"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+
+    return matrix
+
+
+def build_shop_matrices(product_features, shop_domains):
+    """Split products by shop into normalized float32 matrices.
+
+    Returns (shop_products, shop_matrices, position) where position maps a
+    product id to its (shop_domain, row) in the matrices.
+    """
+    shop_products = defaultdict(list)
+    for product_id in product_features:
+        shop_products[shop_domains[product_id]].append(product_id)
+
+    print(f"Found products from {len(shop_products)} different shops")
+
+    shop_matrices = {}
+    position = {}
+    for domain, ids in shop_products.items():
+        matrix = np.ascontiguousarray(
+            [product_features[product_id] for product_id in ids], dtype=np.float32
+        )
+        shop_matrices[domain] = normalize_rows(matrix)
+        for idx, product_id in enumerate(ids):
+            position[product_id] = (domain, idx)
+
+    return shop_products, shop_matrices, position
+
+
+def find_product_groups(product_features, shop_domains, threshold=SIMILARITY_THRESHOLD):
+    """Greedily group each product with its best match from every other shop.
+
+    Products are visited in order. Each unmatched product starts a group and
+    takes the most similar still-unmatched product of every other shop whose
+    cosine similarity reaches the threshold. Similarities are computed
+    exactly with blocked matrix products, bounded by
+    SIMILARITY_BLOCK_ELEMENTS scores at a time.
+    """
+    product_ids = list(product_features.keys())
+    shop_products, shop_matrices, position = build_shop_matrices(
+        product_features, shop_domains
+    )
+    shop_processed = {
+        domain: np.zeros(len(ids), dtype=bool) for domain, ids in shop_products.items()
+    }
+
+    product_groups = []
+    block_size = max(1, SIMILARITY_BLOCK_ELEMENTS // max(1, len(product_ids)))
+
+    for block_start in range(0, len(product_ids), block_size):
+        block_ids = product_ids[block_start : block_start + block_size]
+        pending = [
+            product_id
+            for product_id in block_ids
+            if not shop_processed[position[product_id][0]][position[product_id][1]]
+        ]
+        if not pending:
+            continue
+
+        print(f"Processing product {block_start}/{len(product_ids)}...")
+
+        queries = np.stack(
+            [shop_matrices[position[p][0]][position[p][1]] for p in pending]
+        )
+        block_scores = {
+            domain: queries @ matrix.T for domain, matrix in shop_matrices.items()
+        }
+
+        for row, product_id in enumerate(pending):
+            current_domain, current_idx = position[product_id]
+            if shop_processed[current_domain][current_idx]:
+                continue
+
+            group = [(product_id, 1.0)]  # (product_id, similarity)
+            shop_processed[current_domain][current_idx] = True
+
+            for other_domain, other_products in shop_products.items():
+                if other_domain == current_domain:
+                    continue
+
+                scores = np.where(
+                    shop_processed[other_domain],
+                    -np.inf,
+                    block_scores[other_domain][row],
+                )
+                best = int(np.argmax(scores))
+                max_similarity = float(scores[best])
+
+                # Same test as the former per-pair loop: a positive best match
+                # that reaches the threshold
+                if max_similarity > 0 and max_similarity >= threshold:
+                    group.append((other_products[best], max_similarity))
+                    shop_processed[other_domain][best] = True
+
+            # If we found cross-shop matches
+            if len(group) > 1:
+                product_groups.append(group)
+
+    return product_groups
+
+
+class HammingIndex:
+    """Multi-index hashing lookup of 64-bit hashes within a Hamming radius.
+
+    Hashes are cut into radius + 1 disjoint bit blocks, each with its own
+    exact-match table. Two hashes within the radius agree on at least one
+    block, so candidates come from the block tables only and are verified
+    by popcount.
+    """
+
+    def __init__(self, radius=PHASH_MAX_DISTANCE):
+        self.radius = radius
+        blocks = radius + 1
+        self.blocks = []  # (shift, mask)
+        shift = 0
+        for i in range(blocks):
+            width = 64 // blocks + (1 if i < 64 % blocks else 0)
+            self.blocks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [defaultdict(list) for _ in self.blocks]
+        self.hashes = {}
+
+    def add(self, key, value):
+        self.hashes[key] = value
+        for table, (shift, mask) in zip(self.tables, self.blocks):
+            table[(value >> shift) & mask].append(key)
+
+    def search(self, value):
+        """Return [(key, distance), ...] within the radius, closest first"""
+        seen = set()
+        found = []
+        for table, (shift, mask) in zip(self.tables, self.blocks):
+            for key in table.get((value >> shift) & mask, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                distance = bin(self.hashes[key] ^ value).count("1")
+                if distance <= self.radius:
+                    found.append((key, distance))
+
+        return sorted(found, key=lambda item: item[1])
+
+
+def cosine_similarity(a, b):
+    """Cosine similarity of two feature vectors"""
+    norms = np.linalg.norm(a) * np.linalg.norm(b)
+
+    return float(np.dot(a, b) / norms) if norms else 0.0
+
+
+def find_hash_groups(product_features, shop_domains, hashes, radius=PHASH_MAX_DISTANCE):
+    """Group exact and near-duplicate images across shops by perceptual hash.
+
+    Same greedy rule as find_product_groups, with the Hamming distance of
+    the dHashes instead of the cosine similarity of the embeddings: each
+    ungrouped product takes the closest ungrouped near-duplicate of every
+    other shop. Similarities are still embedding cosines, so they are
+    comparable with the other groups.
+
+    Returns (groups, ids of the grouped products).
+    """
+    if radius < 0 or not hashes:
+        return [], set()
+
+    index = HammingIndex(radius)
+    for product_id in product_features:
+        if product_id in hashes:
+            index.add(product_id, hashes[product_id])
+
+    product_groups = []
+    resolved = set()
+    for product_id in product_features:
+        if product_id in resolved or product_id not in hashes:
+            continue
+
+        domain = shop_domains[product_id]
+        matches = {}
+        for other_id, _ in index.search(hashes[product_id]):
+            other_domain = shop_domains[other_id]
+            if other_domain == domain or other_domain in matches:
+                continue
+            if other_id not in resolved:
+                matches[other_domain] = other_id
+
+        if not matches:
+            continue
+
+        anchor = product_features[product_id]
+        group = [(product_id, 1.0)] + [
+            (other_id, cosine_similarity(anchor, product_features[other_id]))
+            for other_id in matches.values()
+        ]
+        product_groups.append(group)
+        resolved.update(p for p, _ in group)
+
+    return product_groups, resolved
+
+
+def update_product_groups(
+    product_features,
+    shop_domains,
+    groups,
+    changed,
+    hashes=None,
+    threshold=SIMILARITY_THRESHOLD,
+):
+    """Regroup only the products whose features changed since the last run.
+
+    groups maps group ids to [(product_id, similarity), ...] with the anchor
+    product (similarity 1.0) first. Changed products leave their groups
+    first; a group that loses its anchor or is left with one product is
+    split and its remaining members are regrouped too. Each pending product
+    then joins the group of a grouped near-duplicate by perceptual hash
+    (hashes, if given) from another shop, or else the group whose anchor it
+    matches best, absorbing further
+    matching groups from other shops whose members all match that anchor.
+    Otherwise it anchors a new group with the best ungrouped product of
+    every other shop, as in find_product_groups.
+
+    Returns the updated groups. Surviving groups keep their ids and new
+    groups get ids above the previous maximum.
+    """
+    shop_products, shop_matrices, position = build_shop_matrices(
+        product_features, shop_domains
+    )
+
+    def vector(product_id):
+        domain, idx = position[product_id]
+        return shop_matrices[domain][idx]
+
+    def shops(group_id):
+        return {shop_domains[product_id] for product_id, _ in groups[group_id]}
+
+    next_id = max(groups, default=0) + 1
+    pending = set(changed)
+    updated = {}
+    for group_id, members in groups.items():
+        kept = [(p, sim) for p, sim in members if p in position and p not in changed]
+        if len(kept) < 2 or kept[0][0] != members[0][0]:
+            pending.update(p for p, _ in kept)
+        else:
+            updated[group_id] = kept
+    groups = updated
+    print(f"Regrouping {len(pending)} products against {len(groups)} groups")
+
+    membership = {p: gid for gid, members in groups.items() for p, _ in members}
+    shop_grouped = {
+        domain: np.zeros(len(ids), dtype=bool) for domain, ids in shop_products.items()
+    }
+    for product_id in membership:
+        domain, idx = position[product_id]
+        shop_grouped[domain][idx] = True
+
+    # Row i of the anchor matrix belongs to anchor_ids[i], None once merged
+    # away. The matrix grows by doubling as new groups are anchored.
+    anchor_ids = list(groups)
+    dim = len(next(iter(product_features.values()), ()))
+    anchor_matrix = np.empty((max(2 * len(anchor_ids), 64), dim), dtype=np.float32)
+    for row, group_id in enumerate(anchor_ids):
+        anchor_matrix[row] = vector(groups[group_id][0][0])
+
+    def add_anchor(group_id, anchor_vector):
+        nonlocal anchor_matrix
+        if len(anchor_ids) == len(anchor_matrix):
+            anchor_matrix = np.concatenate(
+                [anchor_matrix, np.empty_like(anchor_matrix)]
+            )
+        anchor_matrix[len(anchor_ids)] = anchor_vector
+        anchor_ids.append(group_id)
+
+    hash_index = None
+    if hashes:
+        hash_index = HammingIndex()
+        for product_id, phash in hashes.items():
+            if product_id in position:
+                hash_index.add(product_id, phash)
+
+    for product_id in [p for p in product_features if p in pending]:
+        if product_id in membership:
+            continue
+
+        domain, idx = position[product_id]
+        query = vector(product_id)
+        target = None
+
+        if hash_index is not None and product_id in hashes:
+            for other_id, _ in hash_index.search(hashes[product_id]):
+                group_id = membership.get(other_id)
+                if group_id is not None and domain not in shops(group_id):
+                    target = group_id
+                    break
+
+        if target is not None:
+            similarity = float(vector(groups[target][0][0]) @ query)
+            groups[target].append((product_id, similarity))
+            membership[product_id] = target
+            shop_grouped[domain][idx] = True
+            continue
+
+        scores = anchor_matrix[: len(anchor_ids)] @ query
+
+        for row in np.argsort(-scores):
+            score = float(scores[row])
+            if score <= 0 or score < threshold:
+                break
+
+            group_id = anchor_ids[row]
+            if group_id is None:
+                continue
+
+            if target is None:
+                if domain not in shops(group_id):
+                    target = group_id
+                    groups[target].append((product_id, score))
+                    membership[product_id] = target
+                    shop_grouped[domain][idx] = True
+                continue
+
+            # Merge: the other group must not share a shop with the target and
+            # all its members must match the target anchor
+            if shops(group_id) & shops(target):
+                continue
+
+            anchor = vector(groups[target][0][0])
+            similarities = [float(vector(p) @ anchor) for p, _ in groups[group_id]]
+            if min(similarities) < threshold:
+                continue
+
+            survivor = min(target, group_id)
+            merged = groups.pop(target) + [
+                (p, sim) for (p, _), sim in zip(groups.pop(group_id), similarities)
+            ]
+            anchor_ids[anchor_ids.index(target)] = survivor
+            anchor_ids[row] = None
+            groups[survivor] = merged
+            for p, _ in merged:
+                membership[p] = survivor
+            target = survivor
+
+        if target is not None:
+            continue
+
+        group = [(product_id, 1.0)]  # (product_id, similarity)
+        shop_grouped[domain][idx] = True
+
+        for other_domain, other_products in shop_products.items():
+            if other_domain == domain:
+                continue
+
+            other_scores = np.where(
+                shop_grouped[other_domain],
+                -np.inf,
+                shop_matrices[other_domain] @ query,
+            )
+            best = int(np.argmax(other_scores))
+            max_similarity = float(other_scores[best])
+
+            if max_similarity > 0 and max_similarity >= threshold:
+                group.append((other_products[best], max_similarity))
+                shop_grouped[other_domain][best] = True
+
+        if len(group) > 1:
+            groups[next_id] = group
+            for p, _ in group:
+                membership[p] = next_id
+            add_anchor(next_id, query)
+            next_id += 1
+        else:
+            # Stays available to later products
+            shop_grouped[domain][idx] = False
+
+    return groups
+
+
+def assign_stable_group_ids(product_groups, previous_groups):
+    """Give rebuilt groups the id of the previous group sharing most products"""
+    previous_membership = {
+        product_id: group_id
+        for group_id, members in previous_groups.items()
+        for product_id, _ in members
+    }
+    next_id = max(previous_groups, default=0) + 1
+    groups = {}
+    unmatched = []
+
+    for group in product_groups:
+        overlap = Counter(
+            previous_membership[product_id]
+            for product_id, _ in group
+            if product_id in previous_membership
+        )
+        for group_id, _ in overlap.most_common():
+            if group_id not in groups:
+                groups[group_id] = group
+                break
+        else:
+            unmatched.append(group)
+
+    for group in unmatched:
+        groups[next_id] = group
+        next_id += 1
+
+    return groups
+
+
+class ExactIndex:
+    """Brute-force inner product index over normalized vectors.
+
+    This is the reference backend for validating approximate indexes. It
+    stores nothing on disk.
+    """
+
+    name = "exact"
+    suffix = ""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, matrix):
+        return cls(matrix)
+
+    def save(self, path):
+        pass
+
+    @classmethod
+    def load(cls, path, matrix):
+        return None
+
+    def search(self, queries, k):
+        """Return (ids, scores) of the k best rows per query, best first"""
+        k = min(k, len(self.matrix))
+        ids = np.empty((len(queries), k), dtype=np.int64)
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        block_size = max(1, SIMILARITY_BLOCK_ELEMENTS // max(1, len(self.matrix)))
+
+        for start in range(0, len(queries), block_size):
+            block = queries[start : start + block_size] @ self.matrix.T
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(block, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            ids[start : start + len(block)] = np.take_along_axis(top, order, axis=1)
+            scores[start : start + len(block)] = np.take_along_axis(
+                top_scores, order, axis=1
+            )
+
+        return ids, scores
+
+
+class IVFIndex(ExactIndex):
+    """NumPy-only inverted file index (spherical k-means coarse quantizer).
+
+    Vectors are bucketed under their nearest centroid. A query only scores
+    the vectors of its ANN_NPROBE nearest buckets.
+    """
+
+    name = "ivf"
+    suffix = ".npz"
+
+    def __init__(self, matrix, centroids, list_offsets, list_ids):
+        super().__init__(matrix)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+
+    @staticmethod
+    def _assign(matrix, centroids):
+        assignments = np.empty(len(matrix), dtype=np.int64)
+        block_size = max(1, SIMILARITY_BLOCK_ELEMENTS // max(1, len(centroids)))
+        for start in range(0, len(matrix), block_size):
+            block = matrix[start : start + block_size] @ centroids.T
+            assignments[start : start + len(block)] = np.argmax(block, axis=1)
+
+        return assignments
+
+    @classmethod
+    def build(cls, matrix, iterations=10):
+        nlist = max(1, min(len(matrix), int(4 * np.sqrt(len(matrix)))))
+        rng = np.random.default_rng(0)
+        centroids = matrix[rng.choice(len(matrix), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = cls._assign(matrix, centroids)
+            counts = np.bincount(assignments, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, matrix)
+            # Keep the previous centroid for clusters that lost all members
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = normalize_rows(sums)
+
+        assignments = cls._assign(matrix, centroids)
+        list_ids = np.argsort(assignments, kind="stable")
+        list_offsets = np.searchsorted(assignments[list_ids], np.arange(nlist + 1))
+
+        return cls(matrix, centroids, list_offsets, list_ids)
+
+    def save(self, path):
+        np.savez(
+            path,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_ids=self.list_ids,
+        )
 
-    # Set model to inference mode
-    model.trainable = False
+    @classmethod
+    def load(cls, path, matrix):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+
+        return cls(matrix, data["centroids"], data["list_offsets"], data["list_ids"])
+
+    def search(self, queries, k):
+        nprobe = min(ANN_NPROBE, len(self.centroids))
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        block_size = max(1, SIMILARITY_BLOCK_ELEMENTS // max(1, len(self.centroids)))
+
+        for start in range(0, len(queries), block_size):
+            block = queries[start : start + block_size]
+            probes = np.argpartition(-(block @ self.centroids.T), nprobe - 1, axis=1)
+
+            for offset, query in enumerate(block):
+                row = start + offset
+                candidates = np.concatenate(
+                    [
+                        self.list_ids[self.list_offsets[c] : self.list_offsets[c + 1]]
+                        for c in probes[offset, :nprobe]
+                    ]
+                )
+                if not len(candidates):
+                    continue
+                candidate_scores = self.matrix[candidates] @ query
+                top = np.argsort(-candidate_scores, kind="stable")[:k]
+                ids[row, : len(top)] = candidates[top]
+                scores[row, : len(top)] = candidate_scores[top]
 
-    print("Model loaded successfully.")
+        return ids, scores
 
-    return model
 
+class HNSWIndex(ExactIndex):
+    """HNSW graph index backed by the optional hnswlib package"""
 
-def extract_domain(url):
-    """Extract domain from URL"""
-    try:
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc
-        # Remove www. prefix if present
+    name = "hnsw"
+    suffix = ".bin"
 
-        if domain.startswith("www."):
-            domain = domain[4:]
+    def __init__(self, matrix, index):
+        super().__init__(matrix)
+        self.index = index
 
-        return domain
-    except:
-        return ""
+    @classmethod
+    def build(cls, matrix):
+        import hnswlib
 
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        index.init_index(max_elements=len(matrix), ef_construction=200, M=16)
+        index.add_items(matrix, np.arange(len(matrix)))
 
-def get_image_hash(url):
-    """Create a hash of the image URL to use as a filename"""
+        return cls(matrix, index)
 
-    return hashlib.md5(url.encode("utf-8")).hexdigest()
+    def save(self, path):
+        self.index.save_index(path)
 
+    @classmethod
+    def load(cls, path, matrix):
+        import hnswlib
 
-def download_image(image_url, product_id):
-    """Download image from URL and save to cache directory"""
-    image_hash = get_image_hash(image_url)
-    cache_path = os.path.join(IMAGE_CACHE_DIR, f"{image_hash}.jpg")
+        if not os.path.exists(path):
+            return None
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        index.load_index(path, max_elements=len(matrix))
 
-    # If image already exists in cache, return the path
+        return cls(matrix, index)
 
-    if os.path.exists(cache_path):
-        return cache_path
+    def search(self, queries, k):
+        k = min(k, len(self.matrix))
+        self.index.set_ef(max(ANN_NPROBE * 8, k))
+        labels, distances = self.index.knn_query(queries, k=k)
 
-    try:
-        response = requests.get(image_url, timeout=10)
+        # hnswlib reports inner product distances as 1 - similarity
+        return labels.astype(np.int64), (1 - distances).astype(np.float32)
 
-        if response.status_code == 200:
-            # Save image to cache
-            with open(cache_path, "wb") as f:
-                f.write(response.content)
 
-            return cache_path
-        else:
-            print(
-                f"Failed to download image for product {product_id}: HTTP {response.status_code}"
-            )
+ANN_BACKENDS = {index.name: index for index in (ExactIndex, IVFIndex, HNSWIndex)}
 
-            return None
-    except Exception as e:
-        print(f"Error downloading image for product {product_id}: {e}")
 
-        return None
+def get_shop_index(backend, domain, ids, matrix, index_dir):
+    """Load the persisted index of a shop, rebuilding it if its products changed"""
+    index_cls = ANN_BACKENDS[backend]
+    if index_cls is ExactIndex:
+        return ExactIndex(matrix)
 
+    fingerprint = hashlib.md5("\n".join(ids).encode("utf-8")).hexdigest()
+    safe_domain = domain.replace("/", "_") or "unknown"
+    path = os.path.join(
+        index_dir, f"{safe_domain}.{backend}.{fingerprint}{index_cls.suffix}"
+    )
 
-def extract_image_features(image_path, model):
-    """Extract features from an image using the MobileNetV2 model"""
-    try:
-        # Load and preprocess the image
-        img = keras_image.load_img(image_path, target_size=(224, 224))
-        x = keras_image.img_to_array(img)
-        x = np.expand_dims(x, axis=0)
-        x = preprocess_input(x)
+    index = index_cls.load(path, matrix)
+    if index is not None:
+        print(f"Loaded {backend} index for {domain} ({len(ids)} products)")
+        return index
+
+    print(f"Building {backend} index for {domain} ({len(ids)} products)...")
+    index = index_cls.build(matrix)
+    for stale in os.listdir(index_dir):
+        if stale.startswith(f"{safe_domain}.{backend}."):
+            os.remove(os.path.join(index_dir, stale))
+    index.save(path)
+
+    return index
+
+
+def find_product_groups_ann(
+    product_features,
+    shop_domains,
+    backend,
+    index_dir,
+    threshold=SIMILARITY_THRESHOLD,
+    top_k=ANN_TOP_K,
+):
+    """Greedy cross-shop grouping driven by per-shop approximate indexes.
+
+    Every shop is queried once, in batch, for the top-k candidates of every
+    product of the other shops. The greedy pass then takes the best
+    still-unmatched candidate. Only if all k candidates are taken while the
+    weakest one still reaches the threshold does it fall back to an exact
+    scan of that shop.
+    """
+    product_ids = list(product_features.keys())
+    shop_products, shop_matrices, position = build_shop_matrices(
+        product_features, shop_domains
+    )
+    shop_processed = {
+        domain: np.zeros(len(ids), dtype=bool) for domain, ids in shop_products.items()
+    }
+    indexes = {
+        domain: get_shop_index(
+            backend, domain, shop_products[domain], matrix, index_dir
+        )
+        for domain, matrix in shop_matrices.items()
+    }
 
-        # Extract features with minimal verbosity
-        features = model.predict(x, verbose=0)
+    candidates = {}
+    for domain, matrix in shop_matrices.items():
+        for other_domain, index in indexes.items():
+            if other_domain != domain:
+                candidates[(domain, other_domain)] = index.search(matrix, top_k)
 
-        return features.flatten()
-    except Exception as e:
-        print(f"Error extracting features from {image_path}: {e}")
-        traceback.print_exc()
+    product_groups = []
+    for i, product_id in enumerate(product_ids):
+        current_domain, current_idx = position[product_id]
+        if shop_processed[current_domain][current_idx]:
+            continue
 
-        return None
+        if i % 1000 == 0:
+            print(f"Processing product {i}/{len(product_ids)}...")
+
+        group = [(product_id, 1.0)]  # (product_id, similarity)
+        shop_processed[current_domain][current_idx] = True
+
+        for other_domain, other_products in shop_products.items():
+            if other_domain == current_domain:
+                continue
+
+            ids, scores = candidates[(current_domain, other_domain)]
+            processed = shop_processed[other_domain]
+            best, max_similarity = None, 0.0
+            for idx, score in zip(ids[current_idx], scores[current_idx]):
+                if idx >= 0 and not processed[idx]:
+                    best, max_similarity = int(idx), float(score)
+                    break
+            else:
+                if scores[current_idx][-1] >= threshold:
+                    exact = np.where(
+                        processed,
+                        -np.inf,
+                        shop_matrices[other_domain]
+                        @ shop_matrices[current_domain][current_idx],
+                    )
+                    best = int(np.argmax(exact))
+                    max_similarity = float(exact[best])
+
+            if best is not None and max_similarity > 0 and max_similarity >= threshold:
+                group.append((other_products[best], max_similarity))
+                processed[best] = True
+
+        # If we found cross-shop matches
+        if len(group) > 1:
+            product_groups.append(group)
+
+    return product_groups
+
+
+def ann_recall_report(
+    product_features,
+    shop_domains,
+    backend,
+    index_dir,
+    top_k=ANN_TOP_K,
+    sample_size=1000,
+):
+    """Print recall@1 and recall@k of an ANN backend against exact search"""
+    shop_products, shop_matrices, _ = build_shop_matrices(
+        product_features, shop_domains
+    )
+    rng = np.random.default_rng(0)
+
+    print(f"\n=== Recall of {backend} vs exact (k={top_k}) ===")
+    for other_domain, matrix in shop_matrices.items():
+        exact = ExactIndex(matrix)
+        approx = get_shop_index(
+            backend, other_domain, shop_products[other_domain], matrix, index_dir
+        )
+
+        for domain, queries in shop_matrices.items():
+            if domain == other_domain:
+                continue
+            if len(queries) > sample_size:
+                queries = queries[rng.choice(len(queries), sample_size, replace=False)]
+
+            exact_ids, _ = exact.search(queries, top_k)
+            approx_ids, _ = approx.search(queries, top_k)
+            recall_1 = np.mean(exact_ids[:, 0] == approx_ids[:, 0])
+            recall_k = np.mean(
+                [
+                    len(set(e) & set(a)) / len(e)
+                    for e, a in zip(exact_ids.tolist(), approx_ids.tolist())
+                ]
+            )
+            print(
+                f"  {domain} -> {other_domain}: recall@1 {recall_1:.3f}, "
+                f"recall@{top_k} {recall_k:.3f} ({len(queries)} queries)"
+            )
 
 
 def init_clickhouse_tables(client):
@@ -132,13 +1702,28 @@ def init_clickhouse_tables(client):
         shop_domain String,
         image_url String,
         image_hash String,
+        image_phash UInt64 DEFAULT 0,
         features Array(Float32),
-        processed_at DateTime DEFAULT now()
+        processed_at DateTime DEFAULT now(),
+        model_version LowCardinality(String),
+        embedding_dim UInt32 DEFAULT length(features)
     ) ENGINE = MergeTree()
     ORDER BY (shop_domain, product_id)
     """
     )
 
+    # Rows written before model versions were recorded come from the
+    # TensorFlow MobileNetV2
+    client.command(
+        f"""
+    ALTER TABLE product_image_features
+        ADD COLUMN IF NOT EXISTS model_version LowCardinality(String)
+            DEFAULT '{TFEmbedder.version}',
+        ADD COLUMN IF NOT EXISTS embedding_dim UInt32 DEFAULT length(features),
+        ADD COLUMN IF NOT EXISTS image_phash UInt64 DEFAULT 0 AFTER image_hash
+    """
+    )
+
     # Create table for product groups if it doesn't exist
     client.command(
         """
@@ -150,19 +1735,38 @@ def init_clickhouse_tables(client):
         url String,
         image_url String,
         similarity Float32,
-        created_at DateTime DEFAULT now()
+        created_at DateTime DEFAULT now(),
+        is_anchor UInt8 DEFAULT 0
     ) ENGINE = MergeTree()
     ORDER BY (group_id, shop_domain, product_id)
     """
     )
 
+    # New groups are written here and swapped in atomically
+    client.command(
+        """
+    CREATE TABLE IF NOT EXISTS product_similarity_groups_staging
+    AS product_similarity_groups
+    """
+    )
+
+    # Groups written before anchors were recorded are regrouped around the
+    # most similar member, see load_product_groups
+    for table in ("product_similarity_groups", "product_similarity_groups_staging"):
+        client.command(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS is_anchor UInt8 DEFAULT 0"
+        )
+
     print("ClickHouse tables initialized successfully.")
 
 
-def get_processed_products(client):
-    """Get the list of already processed products from ClickHouse"""
+def get_processed_products(client, model_version):
+    """Get the list of products already processed by a model from ClickHouse"""
     try:
-        result = client.query("SELECT product_id FROM product_image_features")
+        result = client.query(
+            "SELECT product_id FROM product_image_features WHERE model_version = {v:String}",
+            parameters={"v": model_version},
+        )
         processed_ids = set()
 
         # Try different methods to access data based on API version
@@ -192,13 +1796,96 @@ def get_processed_products(client):
         return set()
 
 
-def process_product_images(products, clickhouse_client, batch_size=100):
-    """Process product images and store their features in ClickHouse"""
-    # Get model for feature extraction
-    model = get_model()
+def insert_features(clickhouse_client, features_batch):
+    """Insert a list of feature rows into product_image_features
+
+    Failed inserts are retried INSERT_RETRIES times with a growing backoff.
+    Returns whether the rows were inserted.
+    """
+    # Extract column names and values
+    columns = list(features_batch[0].keys())
+    data = [[item[col] for col in columns] for item in features_batch]
+
+    for attempt in range(INSERT_RETRIES + 1):
+        try:
+            clickhouse_client.insert(
+                "product_image_features", data, column_names=columns
+            )
+            print(f"Inserted {len(features_batch)} product features into ClickHouse")
+
+            return True
+        except Exception as e:
+            print(f"Error inserting batch into ClickHouse: {e}")
+            traceback.print_exc()
+
+            if attempt < INSERT_RETRIES:
+                time.sleep(INSERT_BACKOFF * 2**attempt)
+
+    return False
+
+
+def sync_feature_store(clickhouse_client, feature_store, model_version, product_ids):
+    """Copy the features of product_ids from ClickHouse into the local store"""
+    print(f"Copying features of {len(product_ids)} products into the feature store...")
+    copied = 0
+
+    with clickhouse_client.query_row_block_stream(
+        """
+    SELECT product_id, shop_domain, image_hash, features, image_phash
+    FROM product_image_features
+    WHERE model_version = {v:String}
+    """,
+        parameters={"v": model_version},
+    ) as stream:
+        for block in stream:
+            rows = [
+                {
+                    "product_id": row[0],
+                    "shop_domain": row[1],
+                    "image_hash": row[2],
+                    "features": row[3],
+                    "image_phash": row[4],
+                }
+                for row in block
+                if row[0] in product_ids
+            ]
+            feature_store.append(rows)
+            copied += len(rows)
+
+    print(f"Copied {copied} feature rows into the feature store")
+
+
+def process_product_images(
+    products,
+    clickhouse_client,
+    embedder,
+    batch_size=100,
+    sync_store=True,
+    on_batch=None,
+    processed_ids=None,
+):
+    """Process product images and store their features in ClickHouse
+
+    Images are downloaded and decoded by thread pools ahead of inference,
+    stacked into batches of INFERENCE_BATCH_SIZE for a single model call,
+    and inserted into ClickHouse every `batch_size` products, after which
+    on_batch is called if given.
+
+    processed_ids, the ids already processed by the embedder, is read from
+    ClickHouse unless given, and is updated with the processed products.
+    """
+    feature_store = get_feature_store(embedder.version)
 
     # Get already processed products
-    processed_ids = get_processed_products(clickhouse_client)
+    if processed_ids is None:
+        processed_ids = get_processed_products(clickhouse_client, embedder.version)
+
+    # Features processed before the local store existed, or on another host
+    missing_ids = processed_ids - feature_store.product_ids()
+    if sync_store and missing_ids:
+        sync_feature_store(
+            clickhouse_client, feature_store, embedder.version, missing_ids
+        )
 
     # Filter out already processed products
     products_to_process = [p for p in products if p[0] not in processed_ids]
@@ -206,297 +1893,579 @@ def process_product_images(products, clickhouse_client, batch_size=100):
         f"Processing {len(products_to_process)} new products out of {len(products)} total products"
     )
 
-    # Process products in batches
-    total_batches = (len(products_to_process) + batch_size - 1) // batch_size
-    features_batch = []
+    if not products_to_process:
+        return
 
-    for batch_idx in range(total_batches):
-        start_idx = batch_idx * batch_size
-        end_idx = min((batch_idx + 1) * batch_size, len(products_to_process))
-        batch = products_to_process[start_idx:end_idx]
+    # Load the embedding model only when there is work for it, and only once
+    if not embedder.loaded:
+        embedder.load()
 
-        print(
-            f"Processing batch {batch_idx + 1}/{total_batches} ({start_idx} to {end_idx})"
+    features_batch = []
+    # Vectors of features_batch by content hash, until it is stored
+    batch_vectors = {}
+    batch_products = []
+    batch_hashes = []
+    batch_phashes = []
+    batch_images = []
+    done = 0
+    reused = 0
+
+    def add_row(product, image_hash, phash, product_features):
+        product_id, _, url, image_url = product[:4]
+        features_batch.append(
+            {
+                "product_id": product_id,
+                "shop_domain": extract_domain(url),
+                "image_url": image_url,
+                "image_hash": image_hash,
+                "image_phash": phash,
+                "features": product_features.tolist(),
+                "model_version": embedder.version,
+                "embedding_dim": len(product_features),
+            }
         )
+        batch_vectors[image_hash] = product_features
+        # Mark as processed
+        processed_ids.add(product_id)
+
+    def store_batch():
+        if insert_features(clickhouse_client, features_batch):
+            feature_store.append(features_batch)
+            return
+
+        # Left unprocessed, so that the next run embeds them again
+        lost = {row["product_id"] for row in features_batch}
+        processed_ids.difference_update(lost)
+        print(f"Giving up on {len(lost)} products, the next run retries them")
+
+    def run_inference():
+        # Byte-identical images are embedded once
+        unique = {}
+        for i, image_hash in enumerate(batch_hashes):
+            unique.setdefault(image_hash, i)
+        features = embedder.embed([batch_images[i] for i in unique.values()])
+        vectors = dict(zip(unique, features))
+
+        for product, image_hash, phash in zip(
+            batch_products, batch_hashes, batch_phashes
+        ):
+            add_row(product, image_hash, phash, vectors[image_hash])
+
+        batch_products.clear()
+        batch_hashes.clear()
+        batch_phashes.clear()
+        batch_images.clear()
+
+    for product, prepared in iter_preprocessed_images(products_to_process):
+        done += 1
+        if prepared is None:
+            print(f"Skipping product {product[0]} due to image failure")
+        else:
+            image_hash, image, phash = prepared
+            known = batch_vectors.get(image_hash)
+            if known is None:
+                known = feature_store.vector(image_hash)
+
+            # Images already embedded under another URL or product skip the model
+            if known is not None:
+                add_row(product, image_hash, phash, known)
+                reused += 1
+            else:
+                batch_products.append(product)
+                batch_hashes.append(image_hash)
+                batch_phashes.append(phash)
+                batch_images.append(image)
 
-        for product in batch:
-            product_id = product[0]
-            name = product[1]
-            url = product[2]
-            image_url = product[3]
-            shop_domain = extract_domain(url)
+        if len(batch_images) >= INFERENCE_BATCH_SIZE:
+            run_inference()
+            print(f"Processed {done}/{len(products_to_process)} products")
 
-            # Skip if already processed
+        if len(features_batch) >= batch_size:
+            store_batch()
+            features_batch = []
+            batch_vectors.clear()
+            if on_batch is not None:
+                on_batch()
 
-            if product_id in processed_ids:
-                continue
+    if batch_images:
+        run_inference()
 
-            print(f"Processing product: {product_id} - {name[:30]}...")
+    if features_batch:
+        store_batch()
 
-            # Download image
-            image_path = download_image(image_url, product_id)
+    print(f"Reused stored features for {reused} byte-identical images")
+    print("Finished processing all product images")
 
-            if not image_path:
-                print(f"Skipping product {product_id} due to image download failure")
 
-                continue
+def shard_of(product_id, shards=WORK_SHARDS):
+    """Shard of a product, the same on every host"""
+    digest = hashlib.md5(str(product_id).encode("utf-8")).hexdigest()
 
-            # Extract features
-            image_hash = get_image_hash(image_url)
-            features = extract_image_features(image_path, model)
+    return int(digest[:8], 16) % shards
 
-            if features is None:
-                print(
-                    f"Skipping product {product_id} due to feature extraction failure"
-                )
 
-                continue
+class SQLiteLeaseTable:
+    """Shard leases of worker processes on one host, in a SQLite file.
 
-            # Add to batch for insertion
-            features_batch.append(
-                {
-                    "product_id": product_id,
-                    "shop_domain": shop_domain,
-                    "image_url": image_url,
-                    "image_hash": image_hash,
-                    "features": features.tolist(),
-                }
+    A worker claims a shard nobody finished or holds, or whose lease
+    expired, renews the lease while it makes progress and marks the shard
+    done at the end. Shards of crashed workers become claimable again once
+    their lease expires.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, run_id, shards, ttl=WORK_LEASE_TTL, path=WORK_LEASE_DB):
+        self.run_id = run_id
+        self.shards = shards
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                run_id TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                worker_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (run_id, shard)
+            )
+            """
+        )
+
+    def claim(self, worker_id):
+        """Lease a free shard to worker_id and return it, or None if none is left"""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            taken = {
+                row[0]
+                for row in self.conn.execute(
+                    """
+                    SELECT shard FROM leases
+                    WHERE run_id = ? AND (status = 'done' OR expires_at > ?)
+                    """,
+                    (self.run_id, now),
+                )
+            }
+            free = [shard for shard in range(self.shards) if shard not in taken]
+            if not free:
+                return None
+
+            shard = random.choice(free)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, 'leased', ?)",
+                (self.run_id, shard, worker_id, now + self.ttl),
             )
 
-            # Mark as processed
-            processed_ids.add(product_id)
+            return shard
+        finally:
+            self.conn.execute("COMMIT")
 
-        # Insert batch into ClickHouse
+    def renew(self, shard, worker_id):
+        """Extend the lease of worker_id, False if it lost the shard"""
+        cursor = self.conn.execute(
+            """
+            UPDATE leases SET expires_at = ?
+            WHERE run_id = ? AND shard = ? AND worker_id = ? AND status = 'leased'
+            """,
+            (time.time() + self.ttl, self.run_id, shard, worker_id),
+        )
 
-        if features_batch:
-            try:
-                # Extract column names and values
-                columns = list(features_batch[0].keys())
-                data = [[item[col] for col in columns] for item in features_batch]
+        return cursor.rowcount == 1
 
-                # Insert data
-                clickhouse_client.insert(
-                    "product_image_features", data, column_names=columns
-                )
-                print(
-                    f"Inserted {len(features_batch)} product features into ClickHouse"
-                )
+    def complete(self, shard, worker_id):
+        """Mark a shard as done"""
+        self.conn.execute(
+            """
+            UPDATE leases SET status = 'done'
+            WHERE run_id = ? AND shard = ? AND worker_id = ?
+            """,
+            (self.run_id, shard, worker_id),
+        )
 
-                # Clear batch
-                features_batch = []
-            except Exception as e:
-                print(f"Error inserting batch into ClickHouse: {e}")
-                traceback.print_exc()
 
-    print("Finished processing all product images")
+class ClickHouseLeaseTable(SQLiteLeaseTable):
+    """Shard leases shared by workers on several hosts through ClickHouse.
 
+    ClickHouse has no row locks: a claim inserts a lease row, waits
+    WORK_LEASE_SETTLE seconds for concurrent claims to land and keeps the
+    shard only if its row is the oldest live one. Renewals and completions
+    are new rows. In the rare case two workers still process one shard, the
+    second one skips the products the first already stored.
+    """
 
-def create_product_groups(clickhouse_client):
-    """Create product groups based on image similarity"""
-    print("Creating product groups based on image similarity...")
+    name = "clickhouse"
 
-    # Retrieve all product features from ClickHouse
-    try:
-        result = clickhouse_client.query(
+    def __init__(self, client, run_id, shards, ttl=WORK_LEASE_TTL):
+        self.client = client
+        self.run_id = run_id
+        self.shards = shards
+        self.ttl = ttl
+        client.command(
             """
-        SELECT
-            product_id,
-            shop_domain,
-            features
-        FROM product_image_features
+        CREATE TABLE IF NOT EXISTS feature_shard_leases (
+            run_id String,
+            shard UInt32,
+            worker_id String,
+            status LowCardinality(String),
+            expires_at DateTime64(3),
+            updated_at DateTime64(3) DEFAULT now64(3)
+        ) ENGINE = MergeTree()
+        ORDER BY (run_id, shard, updated_at)
+        TTL toDateTime(updated_at) + INTERVAL 7 DAY
         """
         )
 
-        # Access data based on API version
-        product_features = {}
-        shop_domains = {}
+    def _write(self, shard, worker_id, status):
+        # Server time, so that worker clocks do not matter
+        self.client.command(
+            """
+        INSERT INTO feature_shard_leases (run_id, shard, worker_id, status, expires_at)
+        SELECT {run_id:String}, {shard:UInt32}, {worker_id:String}, {status:String},
+            now64(3) + toIntervalSecond({ttl:UInt32})
+        """,
+            parameters={
+                "run_id": self.run_id,
+                "shard": shard,
+                "worker_id": worker_id,
+                "status": status,
+                "ttl": self.ttl,
+            },
+        )
 
-        try:
-            # Newer versions
-            for row in result.result_rows:
-                product_id = row[0]
-                shop_domain = row[1]
-                features = np.array(row[2])
-                product_features[product_id] = features
-                shop_domains[product_id] = shop_domain
-        except AttributeError:
-            try:
-                # Some versions
-                for row in result.named_results():
-                    product_id = row["product_id"]
-                    shop_domain = row["shop_domain"]
-                    features = np.array(row["features"])
-                    product_features[product_id] = features
-                    shop_domains[product_id] = shop_domain
-            except AttributeError:
-                # Older versions
-                for row in result.rows:
-                    product_id = row[0]
-                    shop_domain = row[1]
-                    features = np.array(row[2])
-                    product_features[product_id] = features
-                    shop_domains[product_id] = shop_domain
+    def _holder(self, shard):
+        result = self.client.query(
+            """
+        SELECT argMin(worker_id, (updated_at, worker_id))
+        FROM feature_shard_leases
+        WHERE run_id = {run_id:String} AND shard = {shard:UInt32}
+            AND status = 'leased' AND expires_at > now64(3)
+        """,
+            parameters={"run_id": self.run_id, "shard": shard},
+        )
 
-        print(f"Retrieved features for {len(product_features)} products")
+        return result.result_rows[0][0]
 
-        # Group products by shop domain
-        shop_products = defaultdict(list)
-        for product_id, domain in shop_domains.items():
-            shop_products[domain].append(product_id)
+    def claim(self, worker_id):
+        """Lease a free shard to worker_id and return it, or None if none is left"""
+        result = self.client.query(
+            """
+        SELECT DISTINCT shard
+        FROM feature_shard_leases
+        WHERE run_id = {run_id:String} AND (status = 'done' OR expires_at > now64(3))
+        """,
+            parameters={"run_id": self.run_id},
+        )
+        taken = {row[0] for row in result.result_rows}
+        free = [shard for shard in range(self.shards) if shard not in taken]
+        random.shuffle(free)
 
-        print(f"Found products from {len(shop_products)} different shops")
+        for shard in free:
+            self._write(shard, worker_id, "leased")
+            time.sleep(WORK_LEASE_SETTLE)
+            if self._holder(shard) == worker_id:
+                return shard
 
-        # Create product groups
-        product_groups = []
-        processed_products = set()
+        return None
 
-        # For each product
-        product_ids = list(product_features.keys())
-        for i, product_id in enumerate(product_ids):
-            if product_id in processed_products:
-                continue
+    def renew(self, shard, worker_id):
+        """Extend the lease of worker_id, False if it lost the shard"""
+        self._write(shard, worker_id, "leased")
 
-            if i % 100 == 0:
-                print(f"Processing product {i}/{len(product_ids)}...")
+        return self._holder(shard) == worker_id
 
-            current_domain = shop_domains[product_id]
-            current_features = product_features[product_id]
+    def complete(self, shard, worker_id):
+        """Mark a shard as done"""
+        self._write(shard, worker_id, "done")
 
-            # Find similar products from different shops
-            group = [(product_id, 1.0)]  # (product_id, similarity)
-            processed_products.add(product_id)
 
-            # For each shop (except the current one)
-            for other_domain, other_products in shop_products.items():
-                if other_domain == current_domain:
-                    continue
+LEASE_BACKENDS = {
+    backend.name: backend for backend in (SQLiteLeaseTable, ClickHouseLeaseTable)
+}
 
-                # Find most similar product from this shop
-                max_similarity = 0
-                most_similar_product = None
 
-                for other_id in other_products:
-                    if other_id in processed_products:
-                        continue
+def get_lease_table(backend, clickhouse_client, run_id, shards):
+    """Return the lease table of a work run"""
+    if backend == ClickHouseLeaseTable.name:
+        return ClickHouseLeaseTable(clickhouse_client, run_id, shards)
 
-                    other_features = product_features[other_id]
-                    similarity = cosine_similarity(
-                        current_features.reshape(1, -1), other_features.reshape(1, -1)
-                    )[0][0]
+    return SQLiteLeaseTable(run_id, shards)
 
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        most_similar_product = other_id
 
-                # If a similar product is found and it's above threshold
-                if most_similar_product and max_similarity >= SIMILARITY_THRESHOLD:
-                    group.append((most_similar_product, float(max_similarity)))
-                    processed_products.add(most_similar_product)
+def run_worker(products, clickhouse_client, embedder, leases, worker_id):
+    """Process the products of claimed shards until no shard is left.
 
-            # If we found cross-shop matches
-            if len(group) > 1:
-                product_groups.append(group)
+    Each worker writes its own feature batches. The local feature store is
+    not synced with the features of other workers, the grouping run does
+    that. The processed ids are read once per worker and the model is loaded
+    once, on the first shard with work, rather than once per shard.
+    """
+    processed_ids = get_processed_products(clickhouse_client, embedder.version)
+    shard_products = defaultdict(list)
+    for product in products:
+        shard_products[shard_of(product[0], leases.shards)].append(product)
+
+    claimed = 0
+    while True:
+        shard = leases.claim(worker_id)
+        if shard is None:
+            break
+
+        claimed += 1
+        print(
+            f"Worker {worker_id} claimed shard {shard}/{leases.shards} "
+            f"({len(shard_products[shard])} products)"
+        )
 
-        print(f"Created {len(product_groups)} product groups")
+        def renew():
+            if not leases.renew(shard, worker_id):
+                print(f"Lost the lease of shard {shard}, another worker may repeat it")
+
+        process_product_images(
+            shard_products[shard],
+            clickhouse_client,
+            embedder,
+            sync_store=False,
+            on_batch=renew,
+            processed_ids=processed_ids,
+        )
+        leases.complete(shard, worker_id)
 
-        # Get product metadata for the grouped products
-        product_metadata = {}
-        grouped_product_ids = set()
-        for group in product_groups:
-            for product_id, _ in group:
-                grouped_product_ids.add(product_id)
+    print(f"Worker {worker_id} finished after {claimed} shards, none left")
 
-        if not grouped_product_ids:
-            print("No product groups found")
-            return 0
 
-        # Create IN clause for SQL query
-        ids_str = "'" + "','".join(grouped_product_ids) + "'"
+def run_worker_process(embedder_name, lease_backend, run_id, shards):
+    """Connect to ClickHouse and work through shards (one --worker process)"""
+    client = clickhouse_connect.get_client(
+        host=os.environ.get("CLICKHOUSE_HOST", "localhost")
+    )
+    embedder = EMBEDDERS[embedder_name]()
+    leases = get_lease_table(lease_backend, client, run_id, shards)
+    products = get_products_from_clickhouse(client)
+
+    run_worker(
+        products, client, embedder, leases, f"{socket.gethostname()}-{os.getpid()}"
+    )
 
-        metadata_query = clickhouse_client.query(
-            f"""
-        SELECT
-            p.*, f.shop_domain
-        FROM product_metadata p
-        JOIN product_image_features f ON p.sku = f.product_id
-        WHERE p.sku IN ({ids_str})
+
+def load_product_groups(clickhouse_client):
+    """Return (groups, rows) currently stored in product_similarity_groups.
+
+    groups maps group ids to [(product_id, similarity), ...] with the stored
+    anchor first, rows maps product ids to their stored row. The order is
+    total, so groups written without an anchor get the same one every time.
+    """
+    result = clickhouse_client.query(
         """
-        )
+    SELECT group_id, product_id, shop_domain, name, url, image_url, similarity, created_at
+    FROM product_similarity_groups
+    ORDER BY group_id, is_anchor DESC, similarity DESC, product_id
+    """
+    )
+
+    groups = defaultdict(list)
+    rows = {}
+    for row in result.named_results():
+        groups[row["group_id"]].append((row["product_id"], row["similarity"]))
+        rows[row["product_id"]] = row
+
+    return dict(groups), rows
 
+
+def fetch_product_metadata(clickhouse_client, product_ids):
+    """Return product_metadata rows with their shop domain, keyed by sku"""
+    if not product_ids:
+        return {}
+
+    # Create IN clause for SQL query
+    ids_str = "'" + "','".join(product_ids) + "'"
+
+    metadata_query = clickhouse_client.query(
+        f"""
+    SELECT
+        p.*, f.shop_domain
+    FROM product_metadata p
+    JOIN (
+        SELECT DISTINCT product_id, shop_domain FROM product_image_features
+    ) f ON p.sku = f.product_id
+    WHERE p.sku IN ({ids_str})
+    """
+    )
+
+    try:
+        # Access metadata based on API version
+        rows = metadata_query.result_rows
+    except AttributeError:
         try:
-            # Access metadata based on API version
-            rows = metadata_query.result_rows
+            rows = list(metadata_query.named_results())
         except AttributeError:
-            try:
-                rows = list(metadata_query.named_results())
-            except AttributeError:
-                rows = metadata_query.rows
+            rows = metadata_query.rows
 
-        # Map product ID to metadata
-        for row in rows:
-            if isinstance(row, dict):
-                product_id = row["sku"]
-                product_metadata[product_id] = row
+    # Map product ID to metadata
+    product_metadata = {}
+    for row in rows:
+        if isinstance(row, dict):
+            product_metadata[row["sku"]] = row
+        else:
+            product_metadata[row[0]] = {  # Assuming sku is the first column
+                "sku": row[0],
+                "name": row[1],
+                "url": row[2],
+                "image_url": row[3],
+                "shop_domain": row[4],
+            }
+
+    return product_metadata
+
+
+def write_product_groups(clickhouse_client, group_data):
+    """Replace product_similarity_groups atomically via the staging table"""
+    clickhouse_client.command("TRUNCATE TABLE product_similarity_groups_staging")
+
+    # Insert new groups in batches
+    batch_size = 1000
+    for i in range(0, len(group_data), batch_size):
+        batch = group_data[i : i + batch_size]
+
+        # Extract column names and values
+        columns = list(batch[0].keys())
+        data = [[item[col] for col in columns] for item in batch]
+
+        # Insert data
+        clickhouse_client.insert(
+            "product_similarity_groups_staging", data, column_names=columns
+        )
+        print(f"Inserted batch of {len(batch)} product groups")
+
+    # Readers see either the old or the new groups, never an empty table
+    clickhouse_client.command(
+        "EXCHANGE TABLES product_similarity_groups_staging AND product_similarity_groups"
+    )
+
+
+def create_product_groups(
+    clickhouse_client,
+    model_version,
+    backend=ANN_BACKEND,
+    recall_report=False,
+    full_rebuild=False,
+):
+    """Create product groups based on image similarity
+
+    Only products whose image changed since the last run are regrouped,
+    unless there are no previous groups or full_rebuild is set. Group ids
+    stay stable across runs. backend only applies to full rebuilds, the
+    changed products are matched exactly against the group anchors.
+    """
+    print("Creating product groups based on image similarity...")
+
+    try:
+        # Features of this model come from the local store, memory-mapped
+        feature_store = get_feature_store(model_version)
+        product_features, shop_domains = feature_store.load()
+
+        print(f"Loaded features for {len(product_features)} products")
+
+        hashes = {}
+        if PHASH_MAX_DISTANCE >= 0:
+            hashes = feature_store.perceptual_hashes()
+
+        if recall_report and backend != "exact":
+            ann_recall_report(
+                product_features, shop_domains, backend, feature_store.ann_dir
+            )
+
+        previous_groups, previous_rows = load_product_groups(clickhouse_client)
+        changed = None
+        if previous_groups and not full_rebuild:
+            changed = feature_store.changed_since_grouping()
+
+        if changed is not None:
+            if not changed:
+                print("No new or changed products, keeping existing groups")
+                return len(previous_groups)
+
+            print(f"Found {len(changed)} new or changed products")
+            product_groups = update_product_groups(
+                product_features, shop_domains, previous_groups, changed, hashes
+            )
+        else:
+            # Exact and near-duplicate images are grouped by hash first, the
+            # embeddings only compare the remaining products
+            hash_groups, resolved = find_hash_groups(
+                product_features, shop_domains, hashes
+            )
+            print(
+                f"Grouped {len(resolved)} products by perceptual hash into {len(hash_groups)} groups"
+            )
+            unresolved = {
+                product_id: features
+                for product_id, features in product_features.items()
+                if product_id not in resolved
+            }
+
+            if backend == "exact":
+                rebuilt = find_product_groups(unresolved, shop_domains)
             else:
-                product_id = row[0]  # Assuming sku is the first column
-                product_metadata[product_id] = {
-                    "sku": row[0],
-                    "name": row[1],
-                    "url": row[2],
-                    "image_url": row[3],
-                    "shop_domain": row[4],
-                }
+                rebuilt = find_product_groups_ann(
+                    unresolved, shop_domains, backend, feature_store.ann_dir
+                )
+
+            product_groups = assign_stable_group_ids(
+                hash_groups + rebuilt, previous_groups
+            )
+
+        print(f"Created {len(product_groups)} product groups")
+
+        if not product_groups:
+            print("No product groups found")
+            return 0
+
+        # Stored rows are reused for products staying in their group, the
+        # metadata of everything else is fetched
+        reused = {}
+        if changed is not None:
+            for group_id, group in product_groups.items():
+                for product_id, _ in group:
+                    row = previous_rows.get(product_id)
+                    stayed = row is not None and row["group_id"] == group_id
+                    if stayed and product_id not in changed:
+                        reused[product_id] = row
+
+        product_metadata = fetch_product_metadata(
+            clickhouse_client,
+            {
+                product_id
+                for group in product_groups.values()
+                for product_id, _ in group
+                if product_id not in reused
+            },
+        )
+        product_metadata.update(reused)
 
-        # Insert groups into ClickHouse
+        now = datetime.now()
         group_data = []
-        for group_id, group in enumerate(product_groups, 1):
-            for product_id, similarity in group:
+        for group_id, group in sorted(product_groups.items()):
+            for position, (product_id, similarity) in enumerate(group):
                 if product_id in product_metadata:
                     metadata = product_metadata[product_id]
+                    group_data.append(
+                        {
+                            "group_id": group_id,
+                            "product_id": product_id,
+                            "shop_domain": metadata.get("shop_domain", ""),
+                            "name": metadata.get("name", ""),
+                            "url": metadata.get("url", ""),
+                            "image_url": metadata.get("image_url", ""),
+                            "similarity": similarity,
+                            "created_at": metadata.get("created_at", now),
+                            "is_anchor": int(position == 0),
+                        }
+                    )
 
-                    # Prepare data for insertion
-                    if isinstance(metadata, dict):
-                        group_data.append(
-                            {
-                                "group_id": group_id,
-                                "product_id": product_id,
-                                "shop_domain": metadata.get("shop_domain", ""),
-                                "name": metadata.get("name", ""),
-                                "url": metadata.get("url", ""),
-                                "image_url": metadata.get("image_url", ""),
-                                "similarity": similarity,
-                            }
-                        )
-                    else:
-                        group_data.append(
-                            {
-                                "group_id": group_id,
-                                "product_id": product_id,
-                                "shop_domain": shop_domains.get(product_id, ""),
-                                "name": metadata[1] if len(metadata) > 1 else "",
-                                "url": metadata[2] if len(metadata) > 2 else "",
-                                "image_url": metadata[3] if len(metadata) > 3 else "",
-                                "similarity": similarity,
-                            }
-                        )
-
-        # Clear existing groups
-        clickhouse_client.command("TRUNCATE TABLE product_similarity_groups")
-
-        # Insert new groups in batches
-        batch_size = 1000
-        for i in range(0, len(group_data), batch_size):
-            batch = group_data[i : i + batch_size]
-
-            # Extract column names and values
-            columns = list(batch[0].keys())
-            data = [[item[col] for col in columns] for item in batch]
-
-            # Insert data
-            clickhouse_client.insert(
-                "product_similarity_groups", data, column_names=columns
-            )
-            print(f"Inserted batch of {len(batch)} product groups")
+        write_product_groups(clickhouse_client, group_data)
+        feature_store.mark_grouped()
 
         print(f"Successfully created and stored {len(product_groups)} product groups")
         return len(product_groups)
@@ -670,30 +2639,114 @@ def get_products_from_clickhouse(client):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Image-based cross-shop product matcher"
+    )
+    parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Use exact (brute-force) similarity search instead of the ANN index",
+    )
+    parser.add_argument(
+        "--ann-backend",
+        choices=[name for name in ANN_BACKENDS if name != "exact"],
+        help="Approximate nearest-neighbour backend of full rebuilds, requires "
+        "--full-rebuild (default: ANN_BACKEND or ivf, hnsw requires hnswlib)",
+    )
+    parser.add_argument(
+        "--embedder",
+        choices=list(EMBEDDERS),
+        default=EMBEDDER,
+        help="Embedding model backend (onnx requires a model from --export-onnx)",
+    )
+    parser.add_argument(
+        "--export-onnx",
+        action="store_true",
+        help="Export the TensorFlow model to an int8 ONNX model and exit",
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        action="store_true",
+        help="Regroup all products instead of only new or changed ones",
+    )
+    parser.add_argument(
+        "--recall-report",
+        action="store_true",
+        help="Print the recall of the ANN backend against exact search",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Only extract features, for shards claimed from the lease table",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of local --worker processes to start",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=WORK_SHARDS,
+        help="Number of shards products are split into in worker mode",
+    )
+    parser.add_argument(
+        "--lease-backend",
+        choices=list(LEASE_BACKENDS),
+        default=WORK_LEASE_BACKEND,
+        help="Lease table shared by the workers (sqlite only works on one host)",
+    )
+    parser.add_argument(
+        "--run-id",
+        default=os.environ.get("WORK_RUN_ID", datetime.utcnow().strftime("%Y-%m-%d")),
+        help="Workers of the same run share shards (default: today's UTC date)",
+    )
+    args = parser.parse_args()
+    # Incremental runs match changed products exactly, an explicitly chosen
+    # ANN backend would silently not be used
+    if args.ann_backend and not args.full_rebuild:
+        parser.error("--ann-backend only applies together with --full-rebuild")
+    if args.exact or ANN_BACKEND == "exact":
+        backend = "exact"
+    else:
+        backend = args.ann_backend or ANN_BACKEND
+
     print("=== Image-Based Cross-Shop Product Matcher ===")
     print("Starting process...")
 
-    # Configure TensorFlow for compatibility
-    print("Configuring TensorFlow...")
+    if args.export_onnx:
+        export_onnx_model()
+        sys.exit(0)
 
-    # Set TensorFlow to use CPU or GPU
-    try:
-        # For TensorFlow 2.x
-        gpus = tf.config.list_physical_devices("GPU")
+    embedder = EMBEDDERS[args.embedder]()
+    print(f"Embedding model: {embedder.version}")
 
-        if gpus:
-            print(f"Found {len(gpus)} GPU(s), using GPU acceleration")
-            # Allow TensorFlow to use memory as needed
+    if args.worker:
+        print(f"\n=== Worker mode: run {args.run_id}, {args.shards} shards ===")
+        client = clickhouse_connect.get_client(
+            host=os.environ.get("CLICKHOUSE_HOST", "localhost")
+        )
+        # Tables are created once before workers start
+        init_clickhouse_tables(client)
+        get_lease_table(args.lease_backend, client, args.run_id, args.shards)
 
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        else:
-            print("No GPUs found, using CPU for processing")
-    except:
-        # Fallback for older TensorFlow versions
-        print("Using CPU for processing (GPU detection not available)")
-        # Force CPU usage if needed
-        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+        worker_args = (args.embedder, args.lease_backend, args.run_id, args.shards)
+        if args.workers <= 1:
+            run_worker_process(*worker_args)
+            sys.exit(0)
+
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=run_worker_process, args=worker_args)
+            for _ in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        sys.exit(max(process.exitcode for process in processes))
 
     # Connect to ClickHouse using environment variables
     try:
@@ -711,11 +2764,17 @@ if __name__ == "__main__":
 
         # Process product images and extract features
         print("\n=== Phase 3: Processing Images ===")
-        process_product_images(products, client)
+        process_product_images(products, client, embedder)
 
         # Create product groups based on image similarity
         print("\n=== Phase 4: Creating Product Groups ===")
-        num_groups = create_product_groups(client)
+        num_groups = create_product_groups(
+            client,
+            embedder.version,
+            backend=backend,
+            recall_report=args.recall_report,
+            full_rebuild=args.full_rebuild,
+        )
 
         # Display product groups
         print("\n=== Phase 5: Results ===")
@@ -11,8 +11,10 @@ def log(message):
     print(f"[{timestamp}] {message}")
 
 def get_tables(client):
-    """Get all tables from the database."""
-    result = client.query("SHOW TABLES")
+    """Get all tables from the database, skipping views (migrations recreate those)."""
+    result = client.query(
+        "SELECT name FROM system.tables WHERE database = currentDatabase() AND engine NOT LIKE '%View' ORDER BY name"
+    )
     return [row[0] for row in result.result_rows]
 
 def get_table_schema(client, table_name):
@@ -4,13 +4,77 @@
 #
 
 import os
+import sys
+import uuid
 import clickhouse_connect
 
 # Table names
 CLICKHOUSE_TABLE_PRODUCTS = "products"
 CLICKHOUSE_TABLE_METADATA = "product_metadata"
+CLICKHOUSE_TABLE_LATEST = "product_latest"
+CLICKHOUSE_TABLE_SEARCH = "product_search"
+
+# Case and accent folded "name sku" text. Must stay in sync with
+# normalize_search_text() in app.py.
+SEARCH_TEXT_EXPR = (
+    "replaceAll(lowerUTF8(replaceRegexpAll("
+    r"normalizeUTF8NFD(concat(toString(name), ' ', sku)), '\\p{Mn}', '')), 'ς', 'σ')"
+)
 MIGRATIONS_TABLE = "schema_migrations"
 
+# Tables derived from the aggregated state of the whole catalogue. They only
+# change with the data, so instead of being aggregated per request they are
+# rebuilt after every scrape (migrations.py --refresh in scrape.entrypoint.sh)
+# into a staging table that is swapped in atomically. Each refresh has its own
+# staging table, as both scrapers refresh when they finish.
+REFRESH_STAGING_PREFIX = "_refresh_"
+DERIVED_TABLES = {
+    # Latest state of every listed product, keyed for /products pagination
+    "product_listing": f"""SELECT
+    sku,
+    assumeNotNull(name) AS name,
+    ifNull(url, '') AS url,
+    ifNull(image_url, '') AS image_url,
+    price,
+    timestamp
+FROM (
+    SELECT
+        sku,
+        argMaxMerge(name) AS name,
+        argMaxMerge(url) AS url,
+        argMaxMerge(image_url) AS image_url,
+        argMaxMerge(price) AS price,
+        max(timestamp) AS timestamp
+    FROM {CLICKHOUSE_TABLE_LATEST}
+    GROUP BY sku
+)
+WHERE name IS NOT NULL AND timestamp > 0""",
+    # /stats counts, taken after OPTIMIZE so the source tables are merged.
+    # Distinct keys are counted anyway, so that re-inserts not merged yet do
+    # not count twice:
+    # - skus: distinct SKUs (total_distinct_products, as before)
+    # - listings: distinct (sku, url), where the row count of the merged
+    #   product_metadata (deduplicated on sku) equalled the SKUs
+    "stats_totals": f"""SELECT
+    uniqExact(sku) AS skus,
+    uniqExact(sku, toString(url)) AS listings
+FROM {CLICKHOUSE_TABLE_METADATA}""",
+    # Distinct SKUs per day, what the row count per day of the merged table was
+    "stats_entries_per_day": f"""SELECT timestamp, uniqExact(sku) AS count
+FROM {CLICKHOUSE_TABLE_PRODUCTS}
+GROUP BY timestamp""",
+    # Distinct SKUs per host
+    "stats_items_per_host": f"""SELECT domain(toString(url)) AS hostname, uniqExact(sku) AS count
+FROM {CLICKHOUSE_TABLE_METADATA}
+GROUP BY hostname""",
+    # SKUs listed under more than one URL, with the number of URLs, where rows
+    # per SKU only counted re-inserts not merged yet
+    "stats_duplicate_skus": f"""SELECT sku, uniqExact(toString(url)) AS count
+FROM {CLICKHOUSE_TABLE_METADATA}
+GROUP BY sku
+HAVING count > 1""",
+}
+
 # Get ClickHouse client
 client = clickhouse_connect.get_client(host=os.getenv("CLICKHOUSE_HOST", "localhost"))
 
@@ -60,6 +124,48 @@ def run_migration(migration_id, sql):
     print(f"Migration {migration_id} applied.")
 
 
+def derived_table_migrations(first_id, table, columns, order_by):
+    """
+    Build the create/backfill migrations of a table in DERIVED_TABLES.
+    """
+    return [
+        {
+            "id": f"{first_id:03d}_create_{table}_table",
+            "sql": f"""
+CREATE TABLE IF NOT EXISTS {table}
+(
+    {columns}
+)
+ENGINE = MergeTree()
+ORDER BY {order_by}
+SETTINGS index_granularity = 8192;
+""",
+        },
+        {
+            "id": f"{first_id + 1:03d}_backfill_{table}",
+            "sql": f"""
+INSERT INTO {table}
+{DERIVED_TABLES[table]};
+""",
+        },
+    ]
+
+
+def refresh_derived_tables():
+    """
+    Rebuild every table in DERIVED_TABLES and swap it in atomically.
+    """
+    for table, select in DERIVED_TABLES.items():
+        print(f"Refreshing {table}...")
+        staging = f"{REFRESH_STAGING_PREFIX}{table}_{uuid.uuid4().hex}"
+        client.command(f"CREATE TABLE {staging} AS {table}")
+        try:
+            client.command(f"INSERT INTO {staging}\n{select}")
+            client.command(f"EXCHANGE TABLES {staging} AND {table}")
+        finally:
+            client.command(f"DROP TABLE IF EXISTS {staging}")
+
+
 def main():
     # Ensure the migrations table exists
     create_migrations_table()
@@ -94,10 +200,175 @@ CREATE TABLE {CLICKHOUSE_TABLE_METADATA}
 ENGINE = ReplacingMergeTree()
 ORDER BY sku
 SETTINGS index_granularity = 8192;
+""",
+        },
+        # Latest known state per SKU, fed by one materialized view per source
+        # table so that either table can be inserted first. Columns a view does
+        # not provide stay NULL/empty and are ignored by the merge functions.
+        # Metadata keeps the value of the latest insert (argMax over the insert
+        # time), backfilled rows count as older than any insert.
+        {
+            "id": "004_create_product_latest_table",
+            "sql": f"""
+CREATE TABLE IF NOT EXISTS {CLICKHOUSE_TABLE_LATEST}
+(
+    sku String,
+    name AggregateFunction(argMax, Nullable(String), DateTime64(3)),
+    url AggregateFunction(argMax, Nullable(String), DateTime64(3)),
+    image_url AggregateFunction(argMax, Nullable(String), DateTime64(3)),
+    price AggregateFunction(argMax, Decimal(10, 2), DateTime),
+    timestamp SimpleAggregateFunction(max, DateTime)
+)
+ENGINE = AggregatingMergeTree()
+ORDER BY sku
+SETTINGS index_granularity = 8192;
+""",
+        },
+        {
+            "id": "005_create_product_latest_prices_mv",
+            "sql": f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS {CLICKHOUSE_TABLE_LATEST}_prices_mv
+TO {CLICKHOUSE_TABLE_LATEST}
+AS SELECT
+    sku,
+    argMaxState(price, timestamp) AS price,
+    max(timestamp) AS timestamp
+FROM {CLICKHOUSE_TABLE_PRODUCTS}
+GROUP BY sku;
+""",
+        },
+        {
+            "id": "006_create_product_latest_metadata_mv",
+            "sql": f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS {CLICKHOUSE_TABLE_LATEST}_metadata_mv
+TO {CLICKHOUSE_TABLE_LATEST}
+AS SELECT
+    sku,
+    argMaxState(CAST(name, 'Nullable(String)'), now64(3)) AS name,
+    argMaxState(CAST(url, 'Nullable(String)'), now64(3)) AS url,
+    argMaxState(CAST(image_url, 'Nullable(String)'), now64(3)) AS image_url
+FROM {CLICKHOUSE_TABLE_METADATA}
+GROUP BY sku;
+""",
+        },
+        {
+            "id": "007_backfill_product_latest_prices",
+            "sql": f"""
+INSERT INTO {CLICKHOUSE_TABLE_LATEST} (sku, price, timestamp)
+SELECT
+    sku,
+    argMaxState(price, timestamp),
+    max(timestamp)
+FROM {CLICKHOUSE_TABLE_PRODUCTS}
+GROUP BY sku;
+""",
+        },
+        {
+            "id": "008_backfill_product_latest_metadata",
+            "sql": f"""
+INSERT INTO {CLICKHOUSE_TABLE_LATEST} (sku, name, url, image_url)
+SELECT
+    sku,
+    argMaxState(CAST(name, 'Nullable(String)'), toDateTime64(0, 3)),
+    argMaxState(CAST(url, 'Nullable(String)'), toDateTime64(0, 3)),
+    argMaxState(CAST(image_url, 'Nullable(String)'), toDateTime64(0, 3))
+FROM {CLICKHOUSE_TABLE_METADATA}
+GROUP BY sku;
+""",
+        },
+        # Normalised search text with an n-gram bloom filter so that substring
+        # searches can skip granules instead of scanning product_metadata. One
+        # row per SKU survives merges, the latest version, which is also the
+        # one queries match (argMax) until the merge happens.
+        {
+            "id": "009_create_product_search_table",
+            "sql": f"""
+CREATE TABLE IF NOT EXISTS {CLICKHOUSE_TABLE_SEARCH}
+(
+    sku String,
+    search_text String,
+    version DateTime64(3) DEFAULT now64(3),
+    INDEX search_text_ngram search_text TYPE ngrambf_v1(3, 65536, 2, 0) GRANULARITY 1
+)
+ENGINE = ReplacingMergeTree(version)
+ORDER BY sku
+SETTINGS index_granularity = 1024;
+""",
+        },
+        {
+            "id": "010_create_product_search_mv",
+            "sql": f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS {CLICKHOUSE_TABLE_SEARCH}_mv
+TO {CLICKHOUSE_TABLE_SEARCH}
+AS SELECT
+    sku,
+    {SEARCH_TEXT_EXPR} AS search_text,
+    now64(3) AS version
+FROM {CLICKHOUSE_TABLE_METADATA};
+""",
+        },
+        {
+            "id": "011_backfill_product_search",
+            "sql": f"""
+INSERT INTO {CLICKHOUSE_TABLE_SEARCH} (sku, search_text, version)
+SELECT
+    sku,
+    {SEARCH_TEXT_EXPR},
+    toDateTime64(0, 3)
+FROM {CLICKHOUSE_TABLE_METADATA};
 """,
         },
     ]
 
+    # Plain counts backing /stats, so the endpoint reads a few rows
+    migrations += derived_table_migrations(
+        12, "stats_totals", "skus UInt64,\n    listings UInt64", "tuple()"
+    )
+    migrations += derived_table_migrations(
+        14,
+        "stats_entries_per_day",
+        "timestamp DateTime,\n    count UInt64",
+        "timestamp",
+    )
+    migrations += derived_table_migrations(
+        16, "stats_items_per_host", "hostname String,\n    count UInt64", "hostname"
+    )
+    migrations += derived_table_migrations(
+        18, "stats_duplicate_skus", "sku String,\n    count UInt64", "sku"
+    )
+
+    # Bumped by scrape.entrypoint.sh after every run so the app can drop its
+    # cached responses.
+    migrations.append(
+        {
+            "id": "020_create_data_version_table",
+            "sql": """
+CREATE TABLE IF NOT EXISTS data_version
+(
+    source String,
+    version DateTime64(3) DEFAULT now64(3)
+)
+ENGINE = MergeTree()
+ORDER BY version
+SETTINGS index_granularity = 8192;
+""",
+        }
+    )
+
+    # Products in page order, so that /products reads a primary key range
+    # per page instead of merging product_latest for the whole catalogue
+    migrations += derived_table_migrations(
+        21,
+        "product_listing",
+        """sku String,
+    name String,
+    url String,
+    image_url String,
+    price Decimal(10, 2),
+    timestamp DateTime""",
+        "(name, sku)",
+    )
+
     # Iterate through migrations and apply any that haven't been run yet
     for migration in migrations:
         if not migration_applied(migration["id"]):
@@ -107,4 +378,7 @@ SETTINGS index_granularity = 8192;
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["--refresh"]:
+        refresh_derived_tables()
+    else:
+        main()
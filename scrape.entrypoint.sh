@@ -26,7 +26,15 @@ while true; do
     echo "Running $SCRIPT"
     python "$SCRIPT"
 
-    for table in $(clickhouse client --host clickhouse -q 'show tables'); do
+    # Views cannot be optimized, and the staging tables belong to refreshes
+    # running in the other scraper
+    for table in $(clickhouse client --host clickhouse -q "select name from system.tables where database = currentDatabase() and engine not like '%View' and not startsWith(name, '_refresh_')"); do
         clickhouse client --host clickhouse -q "optimize table $table final"
     done
+
+    # Rebuild the tables the app reads instead of aggregating per request
+    python /app/migrations.py --refresh
+
+    # Let the app know the data changed so it drops its cached responses
+    clickhouse client --host clickhouse -q "insert into data_version (source) values ('$SCRIPT')"
 done
@@ -0,0 +1,133 @@
+"""Benchmark the parser backends over saved listing and detail pages.
+
+Fixtures are raw HTML files named after the page type they exercise:
+motokinisi-*.html, motomarket-*.html and motomarket-detail-*.html. The
+committed set in scrape/fixtures is small and shaped like the live pages;
+--save downloads the live ones over it. Compare the backends with:
+
+    python scrape/bench_parsers.py --repeat 20
+"""
+
+import os
+import glob
+import time
+import argparse
+from urllib.parse import urljoin
+from parsers import (
+    BACKENDS,
+    get_backend,
+    lxml,
+    parse_motokinisi_listing,
+    parse_motomarket_listing,
+    parse_motomarket_sku,
+)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+SAMPLE_PAGES = {
+    "motokinisi-1.html": "https://motokinisi.gr/gr/krani.html",
+    "motomarket-1.html": "https://www.motomarket-shop.gr/eksoplismos-anabath/endysh",
+}
+
+
+def save_fixtures(fixtures_dir):
+    """Download the sample listing pages and one product page into fixtures_dir."""
+    from crawler import Crawler
+
+    crawler = Crawler(rate_per_host=1, headers={"User-Agent": "Mozilla/5.0"})
+    os.makedirs(fixtures_dir, exist_ok=True)
+
+    def save(name, url):
+        html = crawler.fetch_text(url)
+
+        if html is not None:
+            with open(os.path.join(fixtures_dir, name), "w", encoding="utf-8") as f:
+                f.write(html)
+            print(f"Saved {name} from {url}")
+
+        return html
+
+    for name, url in SAMPLE_PAGES.items():
+        html = save(name, url)
+
+        if html is None or not name.startswith("motomarket-"):
+            continue
+
+        detail_urls = [
+            p["detail_url"] for p in parse_motomarket_listing(html) if p["detail_url"]
+        ]
+
+        if detail_urls:
+            save("motomarket-detail-1.html", urljoin(url, detail_urls[0]))
+
+
+def load_fixtures(fixtures_dir):
+    """Return {page type: [html, ...]} of the fixtures in fixtures_dir."""
+    pages = {"motokinisi": [], "motomarket": [], "motomarket-detail": []}
+
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        kind = os.path.basename(path).rsplit("-", 1)[0]
+
+        if kind in pages:
+            with open(path, encoding="utf-8") as f:
+                pages[kind].append(f.read())
+
+    return pages
+
+
+def parse_all(pages, backend):
+    """Parse every fixture with backend, returning the extracted data."""
+    return (
+        [parse_motokinisi_listing(html, backend) for html in pages["motokinisi"]],
+        [parse_motomarket_listing(html, backend) for html in pages["motomarket"]],
+        [parse_motomarket_sku(html) for html in pages["motomarket-detail"]],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--save", action="store_true", help="download fresh fixtures first"
+    )
+    args = parser.parse_args()
+
+    if args.save:
+        save_fixtures(args.fixtures)
+
+    pages = load_fixtures(args.fixtures)
+    count = sum(len(htmls) for htmls in pages.values())
+
+    if not count:
+        raise SystemExit(f"No fixtures in {args.fixtures}, run with --save first")
+
+    backends = [name for name in BACKENDS if name != "lxml" or lxml]
+    results = {}
+
+    for name in backends:
+        get_backend(name)  # build the parser outside the timed loop
+        results[name] = parse_all(pages, name)
+
+        start = time.perf_counter()
+
+        for _ in range(args.repeat):
+            parse_all(pages, name)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{name:>5}: {count * args.repeat / elapsed:8.1f} pages/s "
+            f"({elapsed * 1000 / args.repeat:.1f} ms per pass over {count} pages)"
+        )
+
+    reference = results[backends[0]]
+
+    for name in backends[1:]:
+        if results[name] != reference:
+            raise SystemExit(f"{name} extracted different data than {backends[0]}")
+
+    print("All backends extracted the same data")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Change detection for the scrapers.
+
+Listing pages are fetched conditionally (If-None-Match/If-Modified-Since)
+and hashed, and products are fingerprinted by (name, url, image_url,
+price). Both are remembered in a local SQLite file between runs, so an
+unchanged page is answered from the stored state without being parsed,
+and only products whose fingerprint changed get a new product_metadata
+row. Price rows are still written daily from the stored state, since the
+price history has a point per day.
+
+The scrapers' source is mounted read-only, so the state lives in
+SCRAPE_STATE_DIR. Entries older than SCRAPE_STATE_MAX_AGE count as
+unknown, which rewrites everything now and then and heals a state that
+drifted from ClickHouse.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import requests
+from typing import NamedTuple, Optional
+
+SCRAPE_STATE_DIR = os.getenv(
+    "SCRAPE_STATE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "metamoto")
+)
+SCRAPE_STATE_MAX_AGE = float(os.getenv("SCRAPE_STATE_MAX_AGE", 7 * 24 * 3600))
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*fields) -> str:
+    """Stable hash of a tuple of JSON serialisable fields."""
+    data = json.dumps(fields, ensure_ascii=False, default=str)
+
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class Page(NamedTuple):
+    """A fetched listing page.
+
+    html is None when the page did not change since it was last stored; rows
+    and has_next then hold what was stored for it.
+    """
+
+    url: str
+    html: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    rows: list = []
+    has_next: bool = False
+
+    @property
+    def unchanged(self) -> bool:
+        return self.html is None
+
+
+class ChangeStore:
+    """Last seen listing pages and product fingerprints of one scraper."""
+
+    def __init__(
+        self, name: str, root: str = SCRAPE_STATE_DIR, max_age=SCRAPE_STATE_MAX_AGE
+    ):
+        self.path = os.path.join(root, f"{name}.sqlite")
+        self.max_age = max_age
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT NOT NULL,
+                    rows TEXT NOT NULL,
+                    has_next INTEGER NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS products (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+
+        return conn
+
+    def lookup_page(self, url: str) -> Optional[Page]:
+        """Return the stored state of url, or None if unknown or expired."""
+        row = (
+            self._connect()
+            .execute(
+                """
+                SELECT etag, last_modified, content_hash, rows, has_next
+                FROM pages WHERE url = ? AND stored_at > ?
+                """,
+                (url, time.time() - self.max_age),
+            )
+            .fetchone()
+        )
+
+        if row is None:
+            return None
+
+        etag, last_modified, content_hash, rows, has_next = row
+
+        return Page(
+            url,
+            None,
+            etag,
+            last_modified,
+            content_hash,
+            json.loads(rows),
+            bool(has_next),
+        )
+
+    def page_from_html(
+        self,
+        url: str,
+        html: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Page:
+        """Return a Page for html, unchanged if it hashes as the stored one."""
+        content_hash = hashlib.sha1(html.encode("utf-8")).hexdigest()
+        stored = self.lookup_page(url)
+
+        if stored is not None and stored.content_hash == content_hash:
+            return stored
+
+        return Page(url, html, etag, last_modified, content_hash)
+
+    def fetch_page(self, crawler, url: str) -> Optional[Page]:
+        """Fetch url conditionally, returning None on failure."""
+        stored = self.lookup_page(url)
+        headers = {}
+
+        if stored is not None:
+            if stored.etag:
+                headers["If-None-Match"] = stored.etag
+            if stored.last_modified:
+                headers["If-Modified-Since"] = stored.last_modified
+
+        try:
+            response = crawler.get(url, headers=headers)
+
+            if response.status_code == 304 and stored is not None:
+                return stored
+
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to fetch page: {url} - {e}")
+
+            return None
+
+        return self.page_from_html(
+            url,
+            response.text,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+
+    def save_page(self, page: Page, rows: list, has_next: bool):
+        """Remember page with the rows extracted from it.
+
+        Call once the rows are stored, so that a failed insert is retried.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    page.url,
+                    page.etag,
+                    page.last_modified,
+                    page.content_hash,
+                    json.dumps(rows, ensure_ascii=False),
+                    int(has_next),
+                    time.time(),
+                ),
+            )
+
+    def changed(self, fingerprints: dict) -> set:
+        """Return the keys of {key: fingerprint} that are new or changed."""
+        conn = self._connect()
+        oldest = time.time() - self.max_age
+        changed = set()
+
+        for key, value in fingerprints.items():
+            row = conn.execute(
+                "SELECT 1 FROM products WHERE key = ? AND fingerprint = ? AND stored_at > ?",
+                (key, value, oldest),
+            ).fetchone()
+
+            if row is None:
+                changed.add(key)
+
+        return changed
+
+    def remember(self, fingerprints: dict):
+        """Record {key: fingerprint} as stored."""
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in fingerprints.items()],
+            )
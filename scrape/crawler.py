@@ -0,0 +1,116 @@
+"""HTTP plumbing shared by the scrapers.
+
+A single keep-alive session with timeouts and retries, shared by worker
+threads and rate limited per host with token buckets, so that crawling
+several categories at once keeps the same politeness budget as crawling
+them one after another.
+"""
+
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from typing import Optional
+
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 30))  # seconds
+REQUEST_RETRIES = int(os.getenv("REQUEST_RETRIES", 3))
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled with `rate` tokens per second."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class Crawler:
+    """Keep-alive HTTP session, rate limited per host."""
+
+    def __init__(
+        self,
+        rate_per_host: float,
+        burst: int = 1,
+        pool_size: int = 10,
+        timeout: float = REQUEST_TIMEOUT,
+        retries: int = REQUEST_RETRIES,
+        headers: Optional[dict] = None,
+    ):
+        self.rate_per_host = rate_per_host
+        self.burst = burst
+        self.timeout = timeout
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+                respect_retry_after_header=True,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def bucket(self, url: str) -> TokenBucket:
+        """Return the token bucket of the host of url."""
+        host = urlparse(url).netloc
+
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate_per_host, self.burst)
+
+            return self.buckets[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET url once its host has budget for another request."""
+        self.bucket(url).acquire()
+        kwargs.setdefault("timeout", self.timeout)
+
+        return self.session.get(url, **kwargs)
+
+    def fetch_text(self, url: str) -> Optional[str]:
+        """Fetch a page, returning its text or None on failure."""
+        try:
+            response = self.get(url)
+            response.raise_for_status()
+
+            return response.text
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to fetch page: {url} - {e}")
+
+            return None
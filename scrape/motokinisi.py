@@ -1,13 +1,16 @@
 import os
-import time
 import logging
-import requests
+import threading
 import clickhouse_connect
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Optional
+from changes import ChangeStore, Page, fingerprint
+from crawler import Crawler
+from parsers import parse_motokinisi_listing
 
-REQUEST_DELAY = 2  # Delay between requests in seconds
+REQUEST_DELAY = 2  # Seconds between requests to the shop, shared by all workers
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", 8))  # Categories crawled at once
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -18,19 +21,18 @@ CLICKHOUSE_TABLE_PRODUCTS = "products"
 CLICKHOUSE_TABLE_METADATA = "product_metadata"
 
 client = clickhouse_connect.get_client(host=os.getenv("CLICKHOUSE_HOST", "localhost"))
+# The ClickHouse client session does not allow concurrent queries
+client_lock = threading.Lock()
 
+crawler = Crawler(rate_per_host=1 / REQUEST_DELAY, pool_size=CRAWL_WORKERS)
+# Last seen pages and products, to skip unchanged ones
+store = ChangeStore("motokinisi")
 
-def fetch_page(url: str) -> Optional[str]:
-    """Fetch a page using requests."""
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
 
-        return response.text
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to fetch page: {url} - {e}")
+def fetch_page(url: str) -> Optional[Page]:
+    """Fetch a page conditionally through the shared, rate-limited session."""
 
-        return None
+    return store.fetch_page(crawler, url)
 
 
 def clean_price(raw_price: str) -> Optional[float]:
@@ -51,67 +53,71 @@ def clean_price(raw_price: str) -> Optional[float]:
         return None
 
 
-def parse_product_data(soup: BeautifulSoup):
-    """Parse product data and insert into ClickHouse."""
-    product_items = soup.find_all("div", class_="product-item")
-    logger.info(f"Found {len(product_items)} products on the page.")
+def today() -> datetime:
+    now = datetime.now(timezone.utc)
 
-    batch_products = []
-    batch_metadata = []
+    return datetime(now.year, now.month, now.day)
 
-    now = datetime.now(timezone.utc)
-    now_date = datetime(now.year, now.month, now.day)
-
-    for item in product_items:
-        try:
-            name_tag = item.select_one(".product-name a")
-            name = name_tag.get_text(strip=True) if name_tag else "Unknown"
-            url = name_tag["href"] if name_tag else "#"
-
-            sku_tag = item.find("div", class_="product-sku")
-            sku = (
-                sku_tag.get_text(strip=True).replace("SKU:", "").strip()
-                if sku_tag
-                else "unknown"
+
+def insert_batches(batch_products: list, batch_metadata: list):
+    """Insert price and metadata rows into ClickHouse."""
+
+    with client_lock:
+        if batch_products:
+            client.insert(
+                f"{CLICKHOUSE_TABLE_PRODUCTS}",
+                batch_products,
+                column_names=["sku", "price", "timestamp"],
+            )
+
+        if batch_metadata:
+            client.insert(
+                f"{CLICKHOUSE_TABLE_METADATA}",
+                batch_metadata,
+                column_names=["sku", "name", "url", "image_url"],
             )
 
-            price_tag = item.find("span", class_="price")
-            raw_price = price_tag.get_text(strip=True) if price_tag else None
-            price = clean_price(raw_price) or 0.00
+    logger.info(
+        f"Inserted {len(batch_products)} product records and {len(batch_metadata)} metadata records into ClickHouse."
+    )
 
-            image_tag = item.find("img", class_="product-image-photo")
-            image_url = ""
 
-            if image_tag:
-                image_url = image_tag.get("src", "")
+def parse_product_data(page: Page) -> bool:
+    """Parse product data, insert it into ClickHouse and return whether a next page exists.
 
-                if "lazy.svg" in image_url:
-                    image_url = image_tag.get("data-src", image_url)
+    Metadata is only inserted for products whose fingerprint changed.
+    """
+    products, has_next = parse_motokinisi_listing(page.html)
+    logger.info(f"Found {len(products)} products on the page.")
 
-            batch_products.append((sku, price, now_date))
-            batch_metadata.append((sku, name, url, image_url))
-        except Exception as e:
-            logger.error(f"Error parsing product: {e}")
+    batch_products = []
+    batch_metadata = []
+    fingerprints = {}
 
-    # Insert batch into ClickHouse
+    now_date = today()
 
-    if batch_products:
-        client.insert(
-            f"{CLICKHOUSE_TABLE_PRODUCTS}",
-            batch_products,
-            column_names=["sku", "price", "timestamp"],
+    for product in products:
+        price = clean_price(product["raw_price"]) or 0.00
+        metadata = (
+            product["sku"],
+            product["name"],
+            product["url"],
+            product["image_url"],
         )
 
-    if batch_metadata:
-        client.insert(
-            f"{CLICKHOUSE_TABLE_METADATA}",
-            batch_metadata,
-            column_names=["sku", "name", "url", "image_url"],
-        )
+        batch_products.append((product["sku"], price, now_date))
+        batch_metadata.append(metadata)
+        fingerprints[product["sku"]] = fingerprint(*metadata[1:], price)
 
-    logger.info(
-        f"Inserted {len(batch_products)} product records and {len(batch_metadata)} metadata records into ClickHouse."
-    )
+    changed = store.changed(fingerprints)
+    batch_metadata = [row for row in batch_metadata if row[0] in changed]
+
+    insert_batches(batch_products, batch_metadata)
+
+    store.remember({sku: fingerprints[sku] for sku in changed})
+    store.save_page(page, [row[:2] for row in batch_products], has_next)
+
+    return has_next
 
 
 def scrape_category(url: str):
@@ -128,19 +134,24 @@ def scrape_category(url: str):
 
             break
 
-        soup = BeautifulSoup(page_content, "html.parser")
-        parse_product_data(soup)
+        if page_content.unchanged:
+            # Same products as last time, only today's prices are written
+            logger.info(f"Page {page} is unchanged since the last run.")
+            now_date = today()
+            insert_batches(
+                [(sku, price, now_date) for sku, price in page_content.rows], []
+            )
+            has_next = page_content.has_next
+        else:
+            has_next = parse_product_data(page_content)
 
         # Check if there are more pages
-        next_page = soup.select_one("li.next a, a.next")
-
-        if not next_page or "href" not in next_page.attrs:
+        if not has_next:
             logger.info("No more pages to scrape.")
 
             break
 
         page += 1
-        time.sleep(REQUEST_DELAY)
 
 
 def main():
@@ -155,8 +166,19 @@ def main():
         "https://motokinisi.gr/gr/eidi-camping.html",
     ]
 
-    for category_url in category_urls:
-        scrape_category(category_url)
+    # Categories are crawled concurrently, the per-host rate limit keeps
+    # requests to the shop REQUEST_DELAY apart
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+        futures = {
+            executor.submit(scrape_category, category_url): category_url
+            for category_url in category_urls
+        }
+
+        for future, category_url in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to scrape category {category_url}: {e}")
 
 
 if __name__ == "__main__":
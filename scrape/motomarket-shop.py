@@ -1,15 +1,20 @@
 import os
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
+from urllib.parse import urljoin, urlparse
 import requests
 from clickhouse_connect import get_client
+from changes import ChangeStore, fingerprint
+from crawler import Crawler
+from parsers import parse_motomarket_listing, parse_motomarket_sku
+
+# Listing pages are fetched as plain HTML; "selenium" renders them in Chrome instead
+LISTING_FETCHER = os.getenv("LISTING_FETCHER", "http")
+# Render every page whose HTML has no products with Selenium (first pages always are)
+SELENIUM_FALLBACK = os.getenv("SELENIUM_FALLBACK", "0") == "1"
+RATE_LIMIT = float(os.getenv("RATE_LIMIT", 2))  # Requests per second to the shop
+DETAIL_WORKERS = int(os.getenv("DETAIL_WORKERS", 8))  # Concurrent detail page fetches
 
 # List of category URLs to scan.
 category_urls = [
@@ -76,157 +81,249 @@ def build_page_url(base_url, page):
     return new_url
 
 
-def scrape_products_from_page(page_url, driver):
-    """
-    Load the page using Selenium, wait until at least one product is loaded,
-    and return a list of product dictionaries.
-    """
-    driver.get(page_url)
-    try:
-        WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "ul.img_o_v > li"))
-        )
-    except Exception:
-        pass
-    html = driver.page_source
-    soup = BeautifulSoup(html, "html.parser")
-    items = soup.select("ul.img_o_v > li")
-    page_products = []
-
-    for li in items:
-        link_tag = li.select_one("div.img a")
+class SeleniumFetcher:
+    """Headless Chrome, started on first use (opt-in fallback)."""
+
+    def __init__(self):
+        self.driver = None
+
+    def fetch(self, page_url):
+        """Load the page and wait until at least one product is rendered."""
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        if self.driver is None:
+            chrome_options = Options()
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--no-sandbox")
+            chrome_options.add_argument("--disable-dev-shm-usage")
+            chrome_options.add_argument("--disable-gpu")
+            chrome_options.add_argument("--disable-setuid-sandbox")
+            chrome_options.add_argument("--window-size=1280,800")
+            self.driver = webdriver.Chrome(options=chrome_options)
+
+        self.driver.get(page_url)
+        try:
+            WebDriverWait(self.driver, 15).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, "ul.img_o_v > li"))
+            )
+        except Exception:
+            pass
 
-        if link_tag:
-            detail_url = link_tag.get("href")
+        return self.driver.page_source
 
-            if detail_url and not detail_url.startswith("http"):
-                detail_url = BASE_URL + detail_url
-            image_tag = link_tag.find("img")
-            image_url = image_tag.get("src") if image_tag else None
+    def close(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
 
-            if image_url and not image_url.startswith("http"):
-                image_url = BASE_URL + image_url
-        else:
-            detail_url = None
-            image_url = None
 
-        title_tag = li.select_one("p.title a")
-        title = title_tag.text.strip() if title_tag else None
+def parse_listing(html, page_url):
+    """Return the product dictionaries of the grid of a listing page."""
+    page_products = []
 
-        price_tag = li.select_one("p.price span.product-price-final")
-        price_str = price_tag.text.strip() if price_tag else None
-        price = parse_price(price_str)
+    for product in parse_motomarket_listing(html):
+        detail_url = product["detail_url"]
+        image_url = product["image_url"]
 
         page_products.append(
             {
-                "title": title,
-                "detail_url": detail_url,
-                "image_url": image_url,
-                "price": price,
+                "title": product["title"],
+                "detail_url": urljoin(page_url, detail_url) if detail_url else None,
+                "image_url": urljoin(page_url, image_url) if image_url else None,
+                "price": parse_price(product["price_str"]),
                 "sku": None,
             }
         )
 
+    return page_products
+
+
+def scrape_products_from_page(page_url, selenium, render_empty=SELENIUM_FALLBACK):
+    """
+    Fetch a listing page and return (page, list of product dictionaries).
+
+    The product grid is expected to be server-rendered, so a plain GET is
+    enough. Selenium is only used with LISTING_FETCHER=selenium, or with
+    render_empty for pages whose HTML has no products.
+
+    Pages that did not change since the last run are not parsed: page is
+    then unchanged and the product list is None. page is None if the page
+    could not be fetched or if its products were rendered by the Selenium
+    fallback, since the HTTP page they fall back from stays the same while
+    the rendered products change.
+    """
+
+    if LISTING_FETCHER == "selenium":
+        page = store.page_from_html(page_url, selenium.fetch(page_url))
+    else:
+        page = store.fetch_page(crawler, page_url)
+
+    if page is not None and page.unchanged:
+        print("Page", page_url, "is unchanged since the last run")
+
+        return page, None
+
+    page_products = parse_listing(page.html, page_url) if page else []
+
+    if not page_products and render_empty and LISTING_FETCHER != "selenium":
+        print("No products in the HTML of", page_url, "- rendering it")
+        page_products = parse_listing(selenium.fetch(page_url), page_url)
+        page = None
+
     print("Found", len(page_products), "products on page", page_url)
 
-    return page_products
+    return page, page_products
 
 
 def get_sku(detail_url):
     """Fetch the product detail page and extract the SKU."""
-    HEADERS = {"User-Agent": "Mozilla/5.0"}
-    resp = requests.get(detail_url, headers=HEADERS)
+    try:
+        resp = crawler.get(detail_url)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to fetch {detail_url}: {e}")
+
+        return None
 
     if resp.status_code != 200:
         return None
-    detail_soup = BeautifulSoup(resp.text, "html.parser")
-    sku_text = detail_soup.find(string=lambda t: "ΚΩΔΙΚΟΣ ΠΡΟΪΟΝΤΟΣ:" in t)
 
-    if sku_text:
-        parts = sku_text.split("ΚΩΔΙΚΟΣ ΠΡΟΪΟΝΤΟΣ:")
+    return parse_motomarket_sku(resp.text)
 
-        if len(parts) > 1:
-            return parts[1].strip()
 
-    return None
+class SkuResolver:
+    """
+    Map detail URLs to SKUs.
 
+    The URLs already known in product_metadata are loaded once per run;
+    only new URLs are resolved from their detail pages, fetched by a
+    bounded pool of DETAIL_WORKERS threads.
+    """
 
-def query_sku_by_url(detail_url, client):
-    """Query the ClickHouse product_metadata table for a SKU using the detail URL."""
-    query = "SELECT sku FROM product_metadata WHERE url = {url:String} LIMIT 1"
-    result = client.query(query, parameters={"url": detail_url})
+    def __init__(self, client, domain, workers=DETAIL_WORKERS):
+        result = client.query(
+            """
+            SELECT url, any(sku)
+            FROM product_metadata
+            WHERE domain(url) = {domain:String} AND sku != ''
+            GROUP BY url
+            """,
+            parameters={"domain": domain},
+        )
+        self.skus = dict(result.result_rows)
+        # Detail pages without a SKU are not fetched again during the run
+        self.missing = set()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        print(f"Loaded {len(self.skus)} known SKUs of {domain}")
+
+    def resolve(self, urls):
+        """Return {url: sku or None} for the given detail URLs."""
+        new_urls = list(
+            {url for url in urls if url not in self.skus and url not in self.missing}
+        )
 
-    if result.result_rows:
-        return result.result_rows[0][0]
+        for url, sku in zip(new_urls, self.pool.map(get_sku, new_urls)):
+            if sku:
+                self.skus[url] = sku
+            else:
+                self.missing.add(url)
 
-    return None
+        if new_urls:
+            print(f"Resolved {len(new_urls)} new product URLs from detail pages")
 
+        return {url: self.skus.get(url) for url in urls}
 
-# Connect to ClickHouse.
-client = get_client(host=os.getenv("CLICKHOUSE_HOST", "localhost"))
+    def close(self):
+        self.pool.shutdown()
 
-# Set up a single headless Selenium driver.
-chrome_options = Options()
-chrome_options.add_argument("--headless")
-chrome_options.add_argument("--no-sandbox")
-chrome_options.add_argument("--disable-dev-shm-usage")
-chrome_options.add_argument("--disable-gpu")
-chrome_options.add_argument("--disable-setuid-sandbox")
-chrome_options.add_argument("--window-size=1280,800")
 
+# Shared keep-alive session, rate limited per host.
+crawler = Crawler(rate_per_host=RATE_LIMIT, headers={"User-Agent": "Mozilla/5.0"})
+# Last seen listing pages and products, to skip unchanged ones
+store = ChangeStore("motomarket-shop")
 
-driver = webdriver.Chrome(options=chrome_options)
 
-# Process each category.
+def scrape_category(base_url, client, selenium, resolver):
+    """
+    Scan all listing pages of a category and store their products.
 
-for base_url in category_urls:
-    category = derive_category(base_url)
+    Price rows are written for every product, metadata rows only for
+    products whose fingerprint changed since the last run.
+    """
     page = 1
+    # An empty first page is always rendered, in case the grid is not in the
+    # HTML, which would otherwise end the category without any products
+    render_empty = SELENIUM_FALLBACK
 
     while True:
         page_url = build_page_url(base_url, page)
         print(f"Scanning page {page}: {page_url}")
-        page_products = scrape_products_from_page(page_url, driver)
+        page_state, page_products = scrape_products_from_page(
+            page_url, selenium, render_empty or page == 1
+        )
 
-        if not page_products:
+        if page == 1 and page_state is None and page_products:
             print(
-                f"No products found on page {page}. Ending scan for category: {base_url}"
+                f"Products of {base_url} are only in the rendered page, "
+                "rendering its empty pages with Selenium"
             )
-
-            break
-        # For each product, check for SKU in ClickHouse; if not found, fetch it.
-
-        for prod in page_products:
-            if prod["detail_url"]:
-                existing_sku = query_sku_by_url(prod["detail_url"], client)
-
-                if existing_sku:
-                    prod["sku"] = existing_sku
-                else:
-                    prod["sku"] = get_sku(prod["detail_url"])
-            else:
-                prod["sku"] = None
+            render_empty = True
 
         # Compute UTC timestamp for today at midnight.
         now = datetime.now(timezone.utc)
         now_date = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
 
-        # Prepare rows for insertion.
-        metadata_rows = [
-            (
-                prod["sku"],
-                prod["title"],
-                prod["detail_url"],
-                prod["image_url"],
+        if page_products is None:
+            # Unchanged page, the same products with today's date
+            page_products = [
+                {"sku": sku, "price": price} for sku, price in page_state.rows
+            ]
+            metadata_rows = []
+        else:
+            # Known URLs are resolved from memory, new ones from detail pages.
+            skus = resolver.resolve(
+                [prod["detail_url"] for prod in page_products if prod["detail_url"]]
+            )
+
+            for prod in page_products:
+                prod["sku"] = skus.get(prod["detail_url"])
+
+            page_products = [prod for prod in page_products if prod["sku"]]
+            fingerprints = {
+                prod["sku"]: fingerprint(
+                    prod["title"], prod["detail_url"], prod["image_url"], prod["price"]
+                )
+                for prod in page_products
+            }
+            changed = store.changed(fingerprints)
+
+            # Prepare rows for insertion.
+            metadata_rows = [
+                (
+                    prod["sku"],
+                    prod["title"],
+                    prod["detail_url"],
+                    prod["image_url"],
+                )
+                for prod in page_products
+                if prod["sku"] in changed
+            ]
+
+        if not page_products:
+            if page == 1:
+                print(
+                    f"ERROR: no products on the first page of {base_url}, "
+                    "the listing markup may have changed"
+                )
+            print(
+                f"No products found on page {page}. Ending scan for category: {base_url}"
             )
-            for prod in page_products
-            if prod["sku"]
-        ]
-        price_rows = [
-            (prod["sku"], prod["price"], now_date)
-            for prod in page_products
-            if prod["sku"]
-        ]
+
+            break
+        price_rows = [(prod["sku"], prod["price"], now_date) for prod in page_products]
 
         if metadata_rows:
             client.insert("product_metadata", metadata_rows)
@@ -240,6 +337,33 @@ for base_url in category_urls:
             )
             print(f"Inserted {len(price_rows)} rows into products for page {page}.")
 
+        if page_state is None or not page_state.unchanged:
+            store.remember({sku: fingerprints[sku] for sku in changed})
+
+            # Pages rendered by the Selenium fallback are not remembered
+            if page_state is not None:
+                store.save_page(
+                    page_state,
+                    [(prod["sku"], prod["price"]) for prod in page_products],
+                    has_next=True,
+                )
+
         page += 1
 
-driver.quit()
+
+def main():
+    # Connect to ClickHouse.
+    client = get_client(host=os.getenv("CLICKHOUSE_HOST", "localhost"))
+    selenium = SeleniumFetcher()
+    resolver = SkuResolver(client, urlparse(category_urls[0]).netloc)
+
+    try:
+        for base_url in category_urls:
+            scrape_category(base_url, client, selenium, resolver)
+    finally:
+        selenium.close()
+        resolver.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""HTML extraction for the scrapers, with pluggable parser backends.
+
+Each page type is described by selectors given both as CSS, for
+BeautifulSoup, and as XPath, compiled once at import for lxml. HTML_PARSER
+picks the backend: "lxml" (libxml2, the default when installed) or "bs4"
+(BeautifulSoup with html.parser). Both return the same fields.
+"""
+
+import os
+import re
+import logging
+import html as html_lib
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # pragma: no cover - lxml is optional
+    lxml = None
+
+TEXT_NODES = etree.XPath(".//text()") if lxml else None
+
+HTML_PARSER = os.getenv("HTML_PARSER", "lxml" if lxml else "bs4")
+
+logger = logging.getLogger(__name__)
+
+
+def has_class(name):
+    """XPath predicate matching elements with the CSS class `name`."""
+
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class Selector:
+    """A CSS selector and its XPath equivalent, compiled for lxml."""
+
+    def __init__(self, css, xpath):
+        self.css = css
+        self.xpath = etree.XPath(xpath) if lxml else None
+
+
+class SoupBackend:
+    """BeautifulSoup with the pure Python html.parser."""
+
+    name = "bs4"
+
+    def parse(self, html):
+        return BeautifulSoup(html, "html.parser")
+
+    def select(self, node, selector):
+        return node.select(selector.css)
+
+    def select_one(self, node, selector):
+        return node.select_one(selector.css)
+
+    def text(self, node, strip=False):
+        """Text of node, with every text piece stripped if strip is set."""
+        return node.get_text(strip=strip) if strip else node.get_text().strip()
+
+    def attr(self, node, name, default=None):
+        return node.get(name, default)
+
+
+class LxmlBackend(SoupBackend):
+    """libxml2 through lxml, with precompiled XPath selectors."""
+
+    name = "lxml"
+
+    def __init__(self):
+        self.parser = lxml.html.HTMLParser(encoding="utf-8")
+
+    def parse(self, html):
+        if not html.strip():
+            return lxml.html.document_fromstring("<html></html>")
+
+        # Bytes, so that pages with an XML encoding declaration parse too
+        return lxml.html.document_fromstring(html.encode("utf-8"), parser=self.parser)
+
+    def select(self, node, selector):
+        return selector.xpath(node)
+
+    def select_one(self, node, selector):
+        found = selector.xpath(node)
+
+        return found[0] if found else None
+
+    def text(self, node, strip=False):
+        if strip:
+            # Like BeautifulSoup's get_text(strip=True), without comments
+            return "".join(piece.strip() for piece in TEXT_NODES(node))
+
+        return node.text_content().strip()
+
+
+BACKENDS = {backend.name: backend for backend in (SoupBackend, LxmlBackend)}
+_backends = {}
+
+
+def get_backend(name=None):
+    """Return the (shared) parser backend instance called `name`."""
+    name = name or HTML_PARSER
+
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+
+    return _backends[name]
+
+
+# motokinisi.gr listing pages
+MK_ITEMS = Selector("div.product-item", f"//div[{has_class('product-item')}]")
+MK_NAME = Selector(".product-name a", f".//*[{has_class('product-name')}]//a")
+MK_SKU = Selector("div.product-sku", f".//div[{has_class('product-sku')}]")
+MK_PRICE = Selector("span.price", f".//span[{has_class('price')}]")
+MK_IMAGE = Selector(
+    "img.product-image-photo", f".//img[{has_class('product-image-photo')}]"
+)
+MK_NEXT = Selector(
+    "li.next a, a.next", f"//li[{has_class('next')}]//a | //a[{has_class('next')}]"
+)
+
+# motomarket-shop.gr listing and detail pages
+MM_ITEMS = Selector("ul.img_o_v > li", f"//ul[{has_class('img_o_v')}]/li")
+MM_LINK = Selector("div.img a", f".//div[{has_class('img')}]//a")
+MM_IMAGE = Selector("img", ".//img")
+MM_TITLE = Selector("p.title a", f".//p[{has_class('title')}]//a")
+MM_PRICE = Selector(
+    "p.price span.product-price-final",
+    f".//p[{has_class('price')}]//span[{has_class('product-price-final')}]",
+)
+MM_SKU_RE = re.compile(r"ΚΩΔΙΚΟΣ ΠΡΟΪΟΝΤΟΣ:([^<]*)")
+
+
+def parse_motokinisi_item(item, backend):
+    """Return the product of a motokinisi.gr listing item, raising if malformed."""
+    name_tag = backend.select_one(item, MK_NAME)
+    sku_tag = backend.select_one(item, MK_SKU)
+    price_tag = backend.select_one(item, MK_PRICE)
+    image_tag = backend.select_one(item, MK_IMAGE)
+
+    url = "#"
+    if name_tag is not None:
+        url = backend.attr(name_tag, "href")
+        if url is None:
+            raise ValueError("product link without href")
+
+    image_url = ""
+
+    if image_tag is not None:
+        image_url = backend.attr(image_tag, "src", "")
+
+        if "lazy.svg" in image_url:
+            image_url = backend.attr(image_tag, "data-src", image_url)
+
+    return {
+        "name": (
+            backend.text(name_tag, strip=True) if name_tag is not None else "Unknown"
+        ),
+        "url": url,
+        "sku": (
+            backend.text(sku_tag, strip=True).replace("SKU:", "").strip()
+            if sku_tag is not None
+            else "unknown"
+        ),
+        "raw_price": (
+            backend.text(price_tag, strip=True) if price_tag is not None else None
+        ),
+        "image_url": image_url,
+    }
+
+
+def parse_motokinisi_listing(html, backend=None):
+    """
+    Return (products, has_next_page) of a motokinisi.gr listing page.
+
+    Products are dictionaries with name, url, sku, raw_price and image_url.
+    """
+    backend = get_backend(backend)
+    doc = backend.parse(html)
+    products = []
+
+    for item in backend.select(doc, MK_ITEMS):
+        # A malformed item is skipped, not the whole page
+        try:
+            products.append(parse_motokinisi_item(item, backend))
+        except Exception as e:
+            logger.error(f"Error parsing product: {e}")
+
+    next_page = backend.select_one(doc, MK_NEXT)
+    has_next = next_page is not None and backend.attr(next_page, "href") is not None
+
+    return products, has_next
+
+
+def parse_motomarket_listing(html, backend=None):
+    """
+    Return the products of a motomarket-shop.gr listing page.
+
+    Products are dictionaries with title, detail_url and image_url (as found
+    in the page, possibly relative) and price_str.
+    """
+    backend = get_backend(backend)
+    doc = backend.parse(html)
+    products = []
+
+    for li in backend.select(doc, MM_ITEMS):
+        link_tag = backend.select_one(li, MM_LINK)
+        detail_url = image_url = None
+
+        if link_tag is not None:
+            detail_url = backend.attr(link_tag, "href")
+            image_tag = backend.select_one(link_tag, MM_IMAGE)
+            image_url = (
+                backend.attr(image_tag, "src") if image_tag is not None else None
+            )
+
+        title_tag = backend.select_one(li, MM_TITLE)
+        price_tag = backend.select_one(li, MM_PRICE)
+
+        products.append(
+            {
+                "title": backend.text(title_tag) if title_tag is not None else None,
+                "detail_url": detail_url,
+                "image_url": image_url,
+                "price_str": backend.text(price_tag) if price_tag is not None else None,
+            }
+        )
+
+    return products
+
+
+def parse_motomarket_sku(html):
+    """Return the SKU of a motomarket-shop.gr detail page, or None.
+
+    A precompiled regular expression over the raw HTML is enough: the SKU
+    is the rest of the text node after "ΚΩΔΙΚΟΣ ΠΡΟΪΟΝΤΟΣ:".
+    """
+    match = MM_SKU_RE.search(html)
+
+    if match:
+        return html_lib.unescape(match.group(1)).strip() or None
+
+    return None